@@ -0,0 +1,71 @@
+# Кэш готовых ответов GET /couriers/<id>: курьеры меняются редко,
+# а опрашиваются часто. Размер ограничен (LRU), записи живут не дольше TTL.
+# Запись хранит версию курьера из БД (couriers.version) и отдаётся, только
+# пока версия в БД та же, поэтому изменения, сделанные другими процессами
+# gunicorn, видны сразу
+import hashlib
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from flask import current_app
+
+
+class CourierCache:
+    def __init__(self, size=1024, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # courier_id -> (expires, version, body, etag)
+        self.items = OrderedDict()
+
+    def get(self, courier_id, version):
+        # Возвращает (body, etag) или None, если записи нет или она
+        # собрана для другой версии курьера
+        with self.lock:
+            item = self.items.get(courier_id)
+            if item is None:
+                return None
+            if item[0] < monotonic() or item[1] != version:
+                del self.items[courier_id]
+                return None
+            self.items.move_to_end(courier_id)
+            return item[2], item[3]
+
+    def put(self, courier_id, version, body):
+        etag = make_etag(body)
+        with self.lock:
+            self.items[courier_id] = (monotonic() + self.ttl, version, body,
+                                      etag)
+            self.items.move_to_end(courier_id)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return etag
+
+    def invalidate(self, courier_id):
+        with self.lock:
+            self.items.pop(courier_id, None)
+
+
+def make_etag(body):
+    if isinstance(body, str):
+        body = body.encode()
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def init_app(app):
+    # COURIER_CACHE_SIZE=0 выключает кэш, ETag при этом всё равно отдаётся
+    size = app.config.get('COURIER_CACHE_SIZE', 1024)
+    if size:
+        app.extensions['courier_cache'] = CourierCache(
+            size, app.config.get('COURIER_CACHE_TTL', 30))
+
+
+def get_cache():
+    return current_app.extensions.get('courier_cache')
+
+
+def invalidate(courier_id):
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(courier_id)
@@ -1,15 +1,25 @@
-from json import loads, dumps, JSONDecodeError
+import logging
 
-from flask import Flask
-from flask_restful import Resource, request
-from jsonschema import validate, ValidationError
+from flask import current_app, request
+from flask_restful import Resource
+from sqlalchemy.orm import joinedload
+from jsonschema import ValidationError
 
 from data import db_session
-from data.couriers import Courier
+from data.couriers import Courier, CourierRegion, WorkingHours, \
+    WorkingIntervals
+from data.assignment import pack_orders
 from data.orders import Order
-from .schemas import POST_COURIER_SCHEMA, PATCH_COURIER_SCHEMA
+from data.order_index import get_index
+from data.stats import CourierRegionStats
+from . import courier_cache
+from .courier_cache import get_cache, make_etag
+from .json_io import dumps, get_body, get_import_items, iter_chunks, \
+    InvalidBody
+from .schemas import validate, POST_COURIER_VALIDATOR, \
+    PATCH_COURIER_VALIDATOR
 
-app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
 
 class CouriersResource(Resource):
@@ -23,28 +33,71 @@ class CouriersResource(Resource):
         }  # Словарь для преобразования в json для ответа
 
         valid = list()
+        seen = set()  # id проверенных элементов из всех пачек
         try:
-            data = loads(request.get_data())['data']
-            assert isinstance(data, list)
-        except Exception:
-            response = app.response_class(
+            # Элементы проверяются и вставляются пачками в одной транзакции
+            for data in iter_chunks(get_import_items()):
+                self.import_chunk(db_sess, data, valid, seen,
+                                  not_validate_couriers)
+        except InvalidBody:
+            db_sess.rollback()
+            response = current_app.response_class(
                 status=400,
                 response=dumps({"error_description": "Invalid JSON"}),
                 mimetype='application/json')
             return response
+
+        # Если непровалидировался id возвращаем их список
+        if not_validate_couriers:
+            db_sess.rollback()
+            logger.info('couriers import rejected invalid=%d',
+                        len(not_validate_couriers))
+            logger.debug('couriers import errors=%s', not_validate_couriers)
+            response = current_app.response_class(
+                response=dumps(unvalidate),
+                status=400,
+                mimetype='application/json'
+            )
+            return response
+
+        db_sess.commit()
+        response = current_app.response_class(
+            response=dumps(
+                {'couriers': [{'id': i} for i in valid]}
+            ),
+            status=201,
+            mimetype='application/json'
+        )
+        return response
+
+    @staticmethod
+    def import_chunk(db_sess, data, valid, seen, not_validate_couriers):
         # Блок проверки данных
-        print(data)
+        logger.debug('couriers import data=%s', data)
+        # Одним запросом находим id, которые уже есть в базе
+        existing = Courier.existing_ids(
+            db_sess, [i.get('courier_id') for i in data if isinstance(i, dict)])
+        couriers = list()  # Строки для вставки
+        regions = list()
+        working_hours = list()
         for current in data:  # Перебор полученных значений
             try:
-                validate(instance=current, schema=POST_COURIER_SCHEMA)
+                validate(instance=current,
+                         validator=POST_COURIER_VALIDATOR)
                 cour_id = current['courier_id']
-                if db_sess.query(Courier).get(cour_id):
+                if cour_id in existing or cour_id in seen:
                     raise ValueError(
                         f'id{cour_id} is already in the database')
-                working_hours = current.pop('working_hours')
-                courier = Courier(**current)
-                courier.add_working_time_to_courier(working_hours, db_sess)
-                db_sess.add(courier)
+                # Все поля разбираем до того, как что-то добавить в списки
+                courier = Courier.to_row(current)
+                courier_regions = Courier.parse_regions(
+                    cour_id, current['regions'])
+                courier_hours = Courier.parse_working_hours(
+                    cour_id, current['working_hours'])
+                couriers.append(courier)
+                regions.extend(courier_regions)
+                working_hours.extend(courier_hours)
+                seen.add(cour_id)
                 valid.append(cour_id)
 
             except ValueError as e:
@@ -53,7 +106,6 @@ class CouriersResource(Resource):
                     'error_description': str(e)
                 }
                 not_validate_couriers.append(validate_error)
-                print(not_validate_couriers)
 
             except ValidationError as e:
                 validate_error = {
@@ -61,48 +113,37 @@ class CouriersResource(Resource):
                     'error_description': str(e.message)
                 }
                 not_validate_couriers.append(validate_error)
-                print(not_validate_couriers)
 
-        # Если непровалидировался id возвращаем их список
+        # После первой ошибки импорт всё равно откатится, дальше только
+        # собираем ошибки
         if not_validate_couriers:
-            response = app.response_class(
-                response=dumps(unvalidate),
-                status=400,
-                mimetype='application/json'
-            )
-            db_sess.close()
-            return response
-
-        db_sess.commit()
-        response = app.response_class(
-            response=dumps(
-                {'couriers': [{'id': i} for i in valid]}
-            ),
-            status=201,
-            mimetype='application/json'
-        )
-        db_sess.close()
-        return response
+            return
+        db_session.bulk_insert(db_sess, Courier, couriers)
+        db_session.bulk_insert(db_sess, CourierRegion, regions)
+        db_session.bulk_insert(db_sess, WorkingHours, working_hours)
 
 
 class CouriersListResource(Resource):
     def patch(self, courier_id):
         db_sess = db_session.create_session()
-        courier = db_sess.query(Courier).get(courier_id)
+        # Курьер вместе с невыполненными заказами одним запросом
+        courier = db_sess.query(Courier).options(
+            joinedload(Courier.outstanding_orders).selectinload(
+                Order.delivery_hours)
+        ).get(courier_id)
         try:
-            validate(instance=loads(request.get_data()),
-                     schema=PATCH_COURIER_SCHEMA)
-            data = loads(request.get_data())
-            print(data)
+            data = get_body()
+            validate(instance=data, validator=PATCH_COURIER_VALIDATOR)
+            logger.debug('courier patch id=%d data=%s', courier_id, data)
             assert isinstance(data, dict)
         except ValidationError as e:
-            response = Flask.response_class(
+            response = current_app.response_class(
                 status=400,
                 response=dumps({"error_description": e.message}),
                 mimetype='application/json')
             return response
         except Exception:
-            response = Flask.response_class(
+            response = current_app.response_class(
                 status=400,
                 response=dumps({"error_description": "Invalid JSON"}),
                 mimetype='application/json')
@@ -114,70 +155,91 @@ class CouriersListResource(Resource):
                 raise ValueError('Invalid courier_id')
             courier.update(db_sess, **data)
             # Блок для проверки доступности заказа с новыми данными
-            orders = db_sess.query(Order).filter(Order.deliver == courier_id,
-                                                 Order.complete == False).all()
-            for order in orders:
-                if (not courier.check_order_time(order)) or \
-                        (order.region not in loads(courier.regions)) or \
-                        (not order.weight <= courier.get_capacity()):
-                    order.deliver = None
-                    order.cost = None
-                    order.assign_time = None
+            orders = list(courier.outstanding_orders)
+            intervals = WorkingIntervals(courier.working_hours)
+            regions = set(courier.regions)
+            keep = [order for order in orders
+                    if courier.check_order_time(order, intervals) and
+                    order.region in regions]
+            # Оставшиеся заказы должны вместе помещаться в новую
+            # грузоподъёмность
+            packed = pack_orders([order.weight for order in keep],
+                                 courier.get_capacity())
+            keep = {keep[i].order_id for i in packed}
+            released = [order for order in orders
+                        if order.order_id not in keep]
+            for order in released:
+                order.deliver = None
+                order.cost = None
+                order.assign_time = None
+            index = get_index()
+            if index is not None:
+                # Снятые с курьера заказы снова свободны. Добавляем до
+                # commit, пока объекты загружены: лишний заказ в индексе
+                # безопасен, его всё равно не даст забрать условный UPDATE
+                index.add_orders(released)
+            courier.touch()
+            # Ответ собираем до commit, чтобы не перечитывать курьера
+            data = courier.to_dict()
             db_sess.commit()
-            response = app.response_class(
-                response=dumps(courier.to_dict()),
+            courier_cache.invalidate(courier_id)
+            response = current_app.response_class(
+                response=dumps(data),
                 status=201,
                 mimetype='application/json'
             )
-            db_sess.close()
             return response
 
         except ValueError as e:
-            response = app.response_class(
+            response = current_app.response_class(
                 status=400,
                 response=dumps({"error_description": str(e)}),
                 mimetype='application/json')
-            db_sess.close()
             return response
 
 
 class CourierInfo(Resource):
     def get(self, courier_id):
-        try:
-            db_sess = db_session.create_session()
-            courier = db_sess.query(Courier).get(courier_id)
-            assert courier
-            data = courier.to_dict()
-            data['earnings'] = courier.earnings
-            # Считаем рейтинг
-            if courier.earnings > 0:
-                td = list()
-                for region in loads(courier.regions):
-                    orders = db_sess.query(Order).filter(
-                        Order.deliver == courier_id,
-                        Order.region == region,
-                        Order.complete == True,
-                    ).order_by(Order.complete_time).all()
-                    if orders:
-                        times = [orders[0].assign_time]
-                        for i in orders:
-                            times.append(i.complete_time)
-                        differences = list()
-                        for i in range(len(times) - 1):
-                            last_order = times[i]
-                            now_order = times[i + 1]
-                            diff = (now_order - last_order)
-                            differences.append(diff.total_seconds())
-                        average = sum(differences) / len(differences)
-                        td.append(average)
-                t = min(td)
-                rating = (60 * 60 - min(t, 60 * 60)) / (60 * 60) * 5
-                data['rating'] = round(rating, 2)
-            response = app.response_class(
+        db_sess = db_session.create_session()
+        cache = get_cache()
+        cached = None
+        if cache is not None:
+            # Запись кэша годится, только пока версия курьера в БД та же:
+            # курьера могли изменить в другом процессе
+            version = db_sess.query(Courier.version).filter(
+                Courier.courier_id == courier_id).scalar()
+            if version is None:
+                return current_app.response_class(status=404)
+            cached = cache.get(courier_id, version)
+        if cached is not None:
+            body, etag = cached
+        else:
+            try:
+                courier = db_sess.query(Courier).get(courier_id)
+                assert courier
+                data = courier.to_dict()
+                data['earnings'] = courier.earnings
+                # Рейтинг по накопленным данным, O(число регионов)
+                if courier.earnings > 0:
+                    rating = CourierRegionStats.get_rating(db_sess, courier)
+                    if rating is not None:
+                        data['rating'] = rating
+            except AssertionError:
+                return current_app.response_class(status=404)
+            body = dumps(data)
+            if cache is not None:
+                etag = cache.put(courier_id, version, body)
+            else:
+                etag = make_etag(body)
+
+        # Клиент уже видел этот ответ - тело не отправляем
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(
                 status=200,
-                response=dumps(data),
+                response=body,
                 mimetype='application/json'
             )
-            return response
-        except AssertionError:
-            return app.response_class(status=404)
+        response.set_etag(etag)
+        return response
@@ -0,0 +1,143 @@
+# Единый слой JSON для всех ресурсов: orjson или ujson, если установлены,
+# иначе стандартный json
+import json
+import shutil
+from itertools import islice
+from tempfile import SpooledTemporaryFile
+from time import perf_counter
+
+from flask import current_app, g, request
+from flask.json.provider import DefaultJSONProvider
+
+from metrics import add_time, timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import ijson  # Потоковый разбор больших импортов
+except ImportError:
+    ijson = None
+
+# Сколько элементов импорта проверяется и вставляется за раз
+IMPORT_CHUNK_SIZE = 1000
+# Сколько байт потокового тела держится в памяти, остальное пишется на диск
+IMPORT_SPOOL_SIZE = 8 * 1024 * 1024
+
+if orjson is not None:
+    BACKEND = 'orjson'
+    loads = orjson.loads
+    _dumps = orjson.dumps  # Возвращает bytes, response_class их принимает
+elif ujson is not None:
+    BACKEND = 'ujson'
+    loads = ujson.loads
+
+    def _dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False)
+else:
+    BACKEND = 'json'
+    loads = json.loads
+    _dumps = json.dumps
+
+
+def dumps(obj):
+    with timed('serialization'):
+        return _dumps(obj)
+
+
+def get_body():
+    # Тело запроса разбирается не больше одного раза за запрос
+    if 'json_body' not in g:
+        with timed('json'):
+            g.json_body = loads(request.get_data())
+    return g.json_body
+
+
+class InvalidBody(Exception):
+    pass
+
+
+def get_import_items():
+    # Элементы массива data из тела импорта. Большое тело (больше
+    # IMPORT_STREAM_THRESHOLD байт или без Content-Length) при установленном
+    # ijson разбирается потоково, и в памяти не держится весь список.
+    # Тело сначала дочитывается во временный файл: пачки пишутся в базу
+    # только после загрузки, и медленный клиент не держит транзакцию записи
+    length = request.content_length
+    threshold = current_app.config.get('IMPORT_STREAM_THRESHOLD')
+    if ijson is not None and threshold is not None and \
+            (length is None or length > threshold):
+        return _stream_items()
+    try:
+        data = get_body()['data']
+        assert isinstance(data, list)
+    except Exception:
+        raise InvalidBody
+    return iter(data)
+
+
+def _stream_items():
+    with SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE) as body:
+        shutil.copyfileobj(request.stream, body)
+        body.seek(0)
+        yield from _parse_items(body)
+
+
+def _parse_items(body):
+    found = False
+
+    def events():
+        nonlocal found
+        for prefix, event, value in ijson.parse(body, use_float=True):
+            if prefix == '' and event not in ('start_map', 'map_key',
+                                              'end_map'):
+                raise InvalidBody  # Тело - не объект
+            if prefix == 'data':
+                if event == 'start_array' and not found:
+                    found = True
+                elif event != 'end_array':
+                    raise InvalidBody  # data - не массив
+            yield prefix, event, value
+
+    items = ijson.items(events(), 'data.item')
+    while True:
+        # Разбор идёт вперемешку с обработкой, время считаем по элементам
+        start = perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            break
+        except ijson.JSONError:
+            raise InvalidBody
+        finally:
+            add_time('json', perf_counter() - start)
+        yield item
+    if not found:
+        raise InvalidBody
+
+
+def iter_chunks(items, size=IMPORT_CHUNK_SIZE):
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    # JSON-провайдер приложения на том же backend
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        data = dumps(obj)
+        return data.decode() if isinstance(data, bytes) else data
+
+    def loads(self, s, **kwargs):
+        return loads(s)
@@ -1,31 +1,30 @@
+import logging
+
 from flask_restful import Resource
-from flask import Flask, request
-from json import loads, dumps
-from jsonschema import validate, ValidationError
-from .schemas import POST_ORDER_SCHEMA
+from flask import current_app
+from sqlalchemy.orm import joinedload, selectinload
+from jsonschema import ValidationError
+from . import courier_cache
+from .json_io import dumps, get_body, get_import_items, iter_chunks, \
+    InvalidBody
+from .schemas import validate, POST_ORDER_VALIDATOR, \
+    POST_COMPLETE_ORDER_VALIDATOR, POST_DISPATCH_VALIDATOR
 from data import db_session
+from data.db_session import IN_CHUNK_SIZE
+from data.assignment import select_orders
 from data.orders import Order, DeliveryHours
-from data.couriers import Courier
+from data.order_index import get_index
+from data.couriers import Courier, WorkingIntervals
+from data.stats import CourierRegionStats
 from datetime import datetime
 
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
-app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
 
 class OrdersResources(Resource):
     def post(self):
-        try:
-            data = loads(request.get_data())
-            assert isinstance(data, dict)
-            data = data['data']
-        except Exception:
-            response = Flask.response_class(
-                status=400,
-                response=dumps({"error_description": "Invalid JSON"}),
-                mimetype='application/json')
-            return response
-
         db_sess = db_session.create_session()
 
         # Список непровалидированных id
@@ -37,35 +36,95 @@ class OrdersResources(Resource):
         }
 
         valid = list()  # Список провалидированных id
-        print(data)
+        seen = set()  # id проверенных элементов из всех пачек
+        index = get_index()
+        # Строки для индекса заказов, добавляются только после commit
+        pending = None if index is None else list()
+        try:
+            # Элементы проверяются и вставляются пачками в одной транзакции
+            for data in iter_chunks(get_import_items()):
+                response = self.import_chunk(
+                    db_sess, data, valid, seen, not_validate_orders, pending)
+                if response is not None:
+                    break
+            else:
+                response = None
+        except InvalidBody:
+            response = current_app.response_class(
+                status=400,
+                response=dumps({"error_description": "Invalid JSON"}),
+                mimetype='application/json')
+
+        if response is None and not_validate_orders:
+            # Если в непровалидированном списке есть значение
+            # в ответ кладём ошибку и отправляем
+            logger.info('orders import rejected invalid=%d',
+                        len(not_validate_orders))
+            logger.debug('orders import errors=%s', not_validate_orders)
+            response = current_app.response_class(
+                response=dumps(unvalidate),
+                status=400,
+                mimetype='application/json'
+            )
+        if response is not None:
+            db_sess.rollback()
+            return response
+
+        # Иначе фиксируем транзакцию и отправляем ответ
+        db_sess.commit()
+        if index is not None:
+            for orders, delivery_hours in pending:
+                index.add_rows(orders, delivery_hours)
+        response = current_app.response_class(
+            response=dumps(
+                {'orders': [{'id': i} for i in valid]}
+            ),
+            status=201,
+            mimetype='application/json'
+        )
+        return response
+
+    @staticmethod
+    def import_chunk(db_sess, data, valid, seen, not_validate_orders,
+                     pending):
+        # Возвращает ответ с ошибкой, если импорт надо прервать
+        logger.debug('orders import data=%s', data)
+        # Одним запросом находим id, которые уже есть в базе
+        existing = Order.existing_ids(
+            db_sess, [i.get('order_id') for i in data if isinstance(i, dict)])
+        orders = list()  # Строки для вставки
+        delivery_hours = list()
         for current in data:  # Перебор полученных значений
             try:
-                validate(instance=current, schema=POST_ORDER_SCHEMA)
-                if db_sess.query(Order).get(current['order_id']):
+                validate(instance=current,
+                         validator=POST_ORDER_VALIDATOR)
+                order_id = current['order_id']
+                if order_id in existing or order_id in seen:
                     raise ValueError(
-                        f"id{current['order_id']} is already in the database")
-                delivery_hours = current.pop('delivery_hours')
-                order = Order(**current)
-                order.add_delivery_time_to_order(delivery_hours, db_sess)
-                db_sess.add(order)
-                valid.append(current['order_id'])
+                        f"id{order_id} is already in the database")
+                # Все поля разбираем до того, как что-то добавить в списки
+                order = Order.to_row(current)
+                order_hours = Order.parse_delivery_hours(
+                    order_id, current['delivery_hours'])
+                orders.append(order)
+                delivery_hours.extend(order_hours)
+                seen.add(order_id)
+                valid.append(order_id)
 
             except ValidationError as e:
-                response = app.response_class(
+                response = current_app.response_class(
                     status=400,
                     response=dumps(
                         {"error_description": e.message}),
                     mimetype='application/json')
-                db_sess.close()
                 return response
 
             except KeyError:
-                response = app.response_class(
+                response = current_app.response_class(
                     status=400,
                     response=dumps(
                         {"error_description": "invalid data format"}),
                     mimetype='application/json')
-                db_sess.close()
                 return response
 
             except ValueError as e:
@@ -76,60 +135,48 @@ class OrdersResources(Resource):
                 not_validate_orders.append(validate_error)
 
             except TypeError as e:
-                response = app.response_class(
+                response = current_app.response_class(
                     status=400,
                     response=dumps({"error_description": str(e)}),
                     mimetype='application/json')
-                db_sess.close()
                 return response
 
+        # После первой ошибки импорт всё равно откатится, дальше только
+        # собираем ошибки
         if not_validate_orders:
-            # Если в непровалидированном списке есть значение
-            # в ответ кладём ошибку и отправляем
-            response = app.response_class(
-                response=dumps(unvalidate),
-                status=400,
-                mimetype='application/json'
-            )
-            db_sess.close()
-            return response
-        # Иначе сохраняем базу данных и отправляем ответ
-        db_sess.commit()
-        response = app.response_class(
-            response=dumps(
-                {'orders': [{'id': i} for i in valid]}
-            ),
-            status=201,
-            mimetype='application/json'
-        )
-        db_sess.close()
-        return response
+            return
+        db_session.bulk_insert(db_sess, Order, orders)
+        db_session.bulk_insert(db_sess, DeliveryHours, delivery_hours)
+        if pending is not None:
+            pending.append((orders, delivery_hours))
 
 
 class OrdersAssign(Resource):
     def post(self):
         try:
-            data = loads(request.get_data())
+            data = get_body()
             assert isinstance(data, dict)
         except Exception:
-            response = app.response_class(
+            response = current_app.response_class(
                 status=400,
                 response=dumps({"error_description": "Invalid JSON"}),
                 mimetype='application/json')
             return response
 
-        if 'courier_id' not in data or\
-                not isinstance(data['courier_id'], int):
-            return app.response_class(status=400)
+        try:
+            validate(instance=data,
+                     validator=POST_COMPLETE_ORDER_VALIDATOR)
+        except ValidationError:
+            return current_app.response_class(status=400)
         db_sess = db_session.create_session()
         courier_id = data['courier_id']
-        courier = db_sess.query(Courier).get(courier_id)
+        # Курьер и все его невыполненные заказы одним запросом с JOIN
+        courier = db_sess.query(Courier).options(
+            joinedload(Courier.outstanding_orders)
+        ).get(courier_id)
 
         if courier:  # Проверяем, есть ли у нас курьер с таким id
-            orders = db_sess.query(Order).filter(
-                Order.complete == False,
-                Order.deliver == courier_id
-            ).all()  # Вытаскиваем с БД все невыполненные заказы этого курьера
+            orders = courier.outstanding_orders
             if orders:
                 # Если они есть - собираем их id в словарь
                 # и время получения для ответа
@@ -137,29 +184,38 @@ class OrdersAssign(Resource):
                 assigned_time = orders[0].assign_time
 
             else:
-                # Если их нет - вытаскиваем с БД все подходящие заказы
-                # без назначеного курьера
-                orders = db_sess.query(Order).filter(
-                    Order.deliver == None,
-                    Order.region.in_(loads(courier.regions)),
-                    Order.weight <= courier.get_capacity()
-                )
-                # Сразу проверяем не назначен ли заказ на другого курьера
-                # и соовтетствие регионам
-                orders_list = list()
                 assigned_time = datetime.now()
-
-                for order in orders:  # Перебираем заказы
-                    # Получаем начало удобного промежутка получения
-                    if courier.check_order_time(order):
-                        # Проверяем на соответствие времени и веса
-                        order.deliver = courier.courier_id
-                        order.cost = 500 * courier.coefficient[courier.courier_type]
-                        order.assign_time = assigned_time
-                        orders_list.append({'id': order.order_id})
-
+                intervals = WorkingIntervals(courier.working_hours)
+                index = get_index()
+                if index is not None:
+                    # Подходящие заказы берём из индекса в памяти
+                    order_ids = index.select(
+                        courier.regions, courier.get_capacity(), intervals)
+                else:
+                    # Если их нет - вытаскиваем с БД все подходящие заказы
+                    # без назначеного курьера
+                    orders = db_sess.query(Order).options(
+                        selectinload(Order.delivery_hours)
+                    ).filter(
+                        Order.deliver == None,
+                        Order.region.in_(courier.regions),
+                        Order.weight <= courier.get_capacity()
+                    ).order_by(Order.order_id)
+                    # Чтение идёт без блокировки записи, подходящие по
+                    # времени заказы отбираем в Python и набираем
+                    # не больше грузоподъёмности
+                    order_ids = [order.order_id for order in select_orders(
+                        courier, orders, intervals)]
+
+                # Короткая транзакция: один условный UPDATE, заказы,
+                # которые успел забрать другой курьер, пропускаются
+                claimed = Order.claim(
+                    db_sess, order_ids, courier.courier_id,
+                    courier.get_order_cost(), assigned_time)
                 db_sess.commit()
-                db_sess.close()
+                if index is not None:
+                    index.discard_taken(db_sess, order_ids, claimed)
+                orders_list = [{'id': i} for i in order_ids if i in claimed]
 
             if orders_list:
                 response_data = {
@@ -170,15 +226,131 @@ class OrdersAssign(Resource):
             else:
                 response_data = {'orders': orders_list}
 
-            response = app.response_class(
+            response = current_app.response_class(
                 response=dumps(response_data),
                 status=200,
                 mimetype='application/json'
             )
             return response
         else:  # Иначе ошибка
-            db_sess.close()
-            return app.response_class(status=400)
+            return current_app.response_class(status=400)
+
+
+class OrdersDispatch(Resource):
+    def post(self):
+        # Назначение заказов сразу многим курьерам: одно чтение
+        # свободных заказов и одна пакетная запись
+        try:
+            data = get_body()
+            assert isinstance(data, dict)
+            validate(instance=data, validator=POST_DISPATCH_VALIDATOR)
+        except ValidationError as e:
+            return current_app.response_class(
+                status=400,
+                response=dumps({"error_description": e.message}),
+                mimetype='application/json')
+        except Exception:
+            response = current_app.response_class(
+                status=400,
+                response=dumps({"error_description": "Invalid JSON"}),
+                mimetype='application/json')
+            return response
+
+        db_sess = db_session.create_session()
+        query = db_sess.query(Courier).options(
+            selectinload(Courier.region_rows),
+            selectinload(Courier.working_hours),
+            selectinload(Courier.outstanding_orders)
+        ).order_by(Courier.courier_id)
+        courier_ids = data.get('courier_ids')
+        if courier_ids is None:  # Без списка - все курьеры
+            couriers = query.all()
+        else:
+            courier_ids = sorted(set(courier_ids))
+            couriers = list()
+            for i in range(0, len(courier_ids), IN_CHUNK_SIZE):
+                couriers.extend(query.filter(Courier.courier_id.in_(
+                    courier_ids[i:i + IN_CHUNK_SIZE])))
+            unknown = set(courier_ids) - {i.courier_id for i in couriers}
+            if unknown:
+                return current_app.response_class(
+                    status=400,
+                    response=dumps({
+                        "error_description": "Unknown courier id",
+                        "couriers": [{'id': i} for i in sorted(unknown)]
+                    }),
+                    mimetype='application/json')
+
+        # Курьеры с невыполненными заказами получают их обратно
+        idle = [courier for courier in couriers
+                if not courier.outstanding_orders]
+
+        # Один проход по свободным заказам с группировкой по районам
+        by_region = dict()
+        if idle:
+            max_capacity = max(courier.get_capacity() for courier in idle)
+            query = db_sess.query(Order).options(
+                selectinload(Order.delivery_hours)
+            ).filter(
+                Order.deliver == None,
+                Order.weight <= max_capacity
+            ).order_by(Order.order_id)
+            # Районы свободных курьеров, если их немного, фильтрует сама БД
+            regions = {region for courier in idle
+                       for region in courier.regions}
+            if len(regions) <= IN_CHUNK_SIZE:
+                query = query.filter(Order.region.in_(sorted(regions)))
+            for order in query:
+                by_region.setdefault(order.region, list()).append(order)
+
+        # Курьеры обрабатываются по порядку id, каждый заказ
+        # достаётся не больше чем одному курьеру
+        assigned_time = datetime.now()
+        taken = set()
+        assignments = dict()
+        for courier in idle:
+            orders = [order for region in set(courier.regions)
+                      for order in by_region.get(region, ())
+                      if order.order_id not in taken]
+            orders.sort(key=lambda order: order.order_id)
+            order_ids = [order.order_id for order in select_orders(
+                courier, orders, WorkingIntervals(courier.working_hours))]
+            taken.update(order_ids)
+            assignments[courier.courier_id] = (courier.get_order_cost(),
+                                               order_ids)
+        claimed = Order.claim_many(db_sess, assignments, assigned_time)
+
+        # Ответ собираем до commit: после него объекты устаревают,
+        # и каждое обращение к курьеру или заказу стало бы запросом
+        result = list()
+        for courier in couriers:
+            if courier.outstanding_orders:
+                orders = courier.outstanding_orders
+                order_ids = [order.order_id for order in orders]
+                courier_time = orders[0].assign_time
+            else:
+                order_ids = claimed[courier.courier_id]
+                courier_time = assigned_time
+            item = {'courier_id': courier.courier_id,
+                    'orders': [{'id': i} for i in order_ids]}
+            if order_ids:
+                item['assigned_time'] = datetime.strftime(courier_time,
+                                                          TIME_FORMAT)
+            result.append(item)
+        db_sess.commit()
+        index = get_index()
+        if index is not None:
+            index.discard_taken(db_sess, sorted(taken), {
+                i for order_ids in claimed.values() for i in order_ids})
+        logger.info('orders dispatch couriers=%d assigned=%d',
+                    len(couriers), sum(len(i) for i in claimed.values()))
+
+        response = current_app.response_class(
+            response=dumps({'couriers': result}),
+            status=200,
+            mimetype='application/json'
+        )
+        return response
 
 
 class OrderComplete(Resource):
@@ -186,18 +358,17 @@ class OrderComplete(Resource):
         db_sess = db_session.create_session()
 
         try:
-            data = loads(request.get_data())
+            data = get_body()
             assert isinstance(data, dict)
         except Exception:
-            response = Flask.response_class(
+            response = current_app.response_class(
                 status=400,
                 response=dumps({"error_description": "Invalid JSON"}),
                 mimetype='application/json')
             return response
 
         if 'courier_id' not in data:
-            db_sess.close()
-            return app.response_class(status=400)
+            return current_app.response_class(status=400)
 
         courier = db_sess.query(Courier).get(data['courier_id'])
         order = db_sess.query(Order).filter(
@@ -207,15 +378,13 @@ class OrderComplete(Resource):
 
         if not order:
             # Если у нас нет такого заказа, либо заказ у другого курьера
-            db_sess.close()
-            return app.response_class(
+            return current_app.response_class(
                 status=400,
                 response=dumps({"error_description": "Unknown order id"}),
                 mimetype='application/json')
 
         if not courier:  # Проверка наличия курьера
-            db_sess.close()
-            return app.response_class(
+            return current_app.response_class(
                 status=400,
                 response=dumps({"error_description": "Unknown courier id"}),
                 mimetype='application/json')
@@ -224,26 +393,35 @@ class OrderComplete(Resource):
             datetime.strptime(data["complete_time"], TIME_FORMAT)
             complete_time = data["complete_time"]
         except Exception as e:
-            db_sess.close()
-            return app.response_class(
+            return current_app.response_class(
                 status=400,
                 response=dumps({"error_description": str(e)}),
                 mimetype='application/json')
 
-        order.complete = True
-        for i in db_sess.query(DeliveryHours).filter(
-                DeliveryHours.order_id == order.order_id
-        ):
-            order.delivery_hours.remove(i)
-        order.complete_time = datetime.strptime(complete_time, TIME_FORMAT)
-        courier.earnings += order.cost
-        db_sess.commit()
-
-        response = app.response_class(
+        order_id = order.order_id
+        if not order.complete:  # Повторное выполнение ничего не меняет
+            order.complete = True
+            for i in db_sess.query(DeliveryHours).filter(
+                    DeliveryHours.order_id == order.order_id
+            ):
+                order.delivery_hours.remove(i)
+            order.complete_time = datetime.strptime(complete_time,
+                                                    TIME_FORMAT)
+            courier.earnings += order.cost
+            courier.touch()
+            courier_id = courier.courier_id
+            CourierRegionStats.add_order(db_sess, courier_id, order)
+            db_sess.commit()
+            # Заработок и рейтинг курьера изменились
+            courier_cache.invalidate(courier_id)
+            index = get_index()
+            if index is not None:
+                index.discard([order_id])
+
+        response = current_app.response_class(
             status=200,
-            response=dumps({'order_id': order.order_id}),
+            response=dumps({'order_id': order_id}),
             mimetype='application/json'
         )
 
-        db_sess.close()
         return response
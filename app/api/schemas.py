@@ -1,3 +1,8 @@
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+from metrics import timed
+
 POST_COURIER_SCHEMA = {
     "type": "object",
     "title": "The root schema of delivery",
@@ -186,4 +191,43 @@ POST_COMPLETE_ORDER_SCHEMA = {
         }
     },
     "additionalProperties": False
-}
\ No newline at end of file
+}
+
+POST_DISPATCH_SCHEMA = {
+    "type": "object",
+    "title": "The dispatch schema",
+    "properties": {
+        "courier_ids": {
+            "type": "array",
+            "items": {
+                "type": "integer",
+                "minimum": 0
+            }
+        }
+    },
+    "additionalProperties": False
+}
+
+
+def _compile(schema):
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+# Валидаторы собираются один раз при импорте модуля,
+# чтобы не проверять мета-схему на каждом элементе запроса
+POST_COURIER_VALIDATOR = _compile(POST_COURIER_SCHEMA)
+PATCH_COURIER_VALIDATOR = _compile(PATCH_COURIER_SCHEMA)
+POST_ORDER_VALIDATOR = _compile(POST_ORDER_SCHEMA)
+POST_COMPLETE_ORDER_VALIDATOR = _compile(POST_COMPLETE_ORDER_SCHEMA)
+POST_DISPATCH_VALIDATOR = _compile(POST_DISPATCH_SCHEMA)
+
+
+def validate(instance, validator):
+    # validator - один из *_VALIDATOR выше, ошибка как у jsonschema.validate
+    with timed('validation'):
+        # Быстрая проверка, полный разбор ошибок только для невалидных данных
+        if validator.is_valid(instance):
+            return
+        raise best_match(validator.iter_errors(instance))
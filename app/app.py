@@ -1,23 +1,55 @@
+import os
+
 from flask import Flask
-from data import db_session
+from data import db_session, order_index
 from api.courier_resources import CouriersResource, CouriersListResource, CourierInfo
-from api.orders_resources import OrdersResources, OrdersAssign, OrderComplete
+from api.orders_resources import OrdersResources, OrdersAssign, \
+    OrdersDispatch, OrderComplete
 from flask_restful import Api
+from api import courier_cache
+from api.json_io import FastJSONProvider
+from log import setup_logging
+import metrics
+
+
+def create_app(config=None):
+    # Движок БД, JSON-провайдер и валидаторы схем создаются здесь,
+    # поэтому при gunicorn --preload это происходит до fork
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    app.config['DATABASE'] = os.environ.get('DATABASE_URL', 'db/delivery.db')
+    app.config['ORDER_INDEX'] = os.environ.get('ORDER_INDEX') == '1'
+    app.config['COURIER_CACHE_SIZE'] = int(
+        os.environ.get('COURIER_CACHE_SIZE', 1024))
+    app.config['COURIER_CACHE_TTL'] = float(
+        os.environ.get('COURIER_CACHE_TTL', 30))
+    # Импорт больше этого размера в байтах разбирается потоково (нужен ijson)
+    app.config['IMPORT_STREAM_THRESHOLD'] = int(
+        os.environ.get('IMPORT_STREAM_THRESHOLD', 8 * 1024 * 1024))
+    if config:
+        app.config.update(config)
+
+    db_session.init_app(app)
+    metrics.init_app(app, db_session.get_engine(app))
+    order_index.init_app(app)
+    courier_cache.init_app(app)
+
+    api = Api(app)
+    api.add_resource(CouriersResource, '/couriers')
+    api.add_resource(CouriersListResource, '/couriers/<int:courier_id>')
+    api.add_resource(CourierInfo, '/couriers/<int:courier_id>')
+    api.add_resource(OrdersResources, '/orders')
+    api.add_resource(OrdersAssign, '/orders/assign')
+    api.add_resource(OrdersDispatch, '/orders/dispatch')
+    api.add_resource(OrderComplete, '/orders/complete')
+    return app
 
-app = Flask(__name__)
-api = Api(app)
 
 def main():
+    setup_logging()
+    app = create_app()
     app.run(host='0.0.0.0', port=8080, threaded=True)
-    db_session.global_init('db/delivery.db')
-
 
-api.add_resource(CouriersResource, '/couriers')
-api.add_resource(CouriersListResource, '/couriers/<int:courier_id>')
-api.add_resource(CourierInfo, '/couriers/<int:courier_id>')
-api.add_resource(OrdersResources, '/orders')
-api.add_resource(OrdersAssign, '/orders/assign')
-api.add_resource(OrderComplete, '/orders/complete')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,18 @@
+# Пересчёт данных для рейтинга курьеров по уже выполненным заказам.
+# Запуск из директории app/: python backfill.py [путь к базе]
+import sys
+
+from data import db_session
+from data.stats import backfill_region_stats
+
+
+def main(db_file='db/delivery.db'):
+    db_session.global_init(db_file)
+    db_sess = db_session.create_session()
+    count = backfill_region_stats(db_sess)
+    db_sess.close()
+    print(f'Обработано выполненных заказов: {count}')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
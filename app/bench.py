@@ -0,0 +1,418 @@
+"""Сценарии замеров производительности горячих участков сервиса.
+
+Каждый сценарий bench_* возвращает словарь {замер: мкс на операцию}.
+bench_suite.py прогоняет сценарии на наборах данных разного размера,
+а этот файл, запущенный из директории app/, выводит сравнения реализаций
+(валидаторы, разбор времени, JSON, упаковка заказов, настройки SQLite)
+и проверки под параллельной нагрузкой на одном наборе данных:
+
+    python bench.py
+"""
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import count
+from json import dumps, loads
+
+from jsonschema import validate as jsonschema_validate
+from sqlalchemy import text
+
+from api import json_io
+from api.schemas import validate, POST_COURIER_VALIDATOR, POST_ORDER_VALIDATOR
+from data import assignment, db_session
+from data.couriers import Courier, WorkingIntervals
+from data.hours import parse_time, format_interval
+from data.orders import Order
+
+# Заказов в одном районе, число районов растёт вместе с данными
+ORDERS_PER_REGION = 50
+IMPORT_CHUNK = 10000
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+TYPES = ('foot', 'bike', 'car')
+
+COURIER = {
+    "courier_id": 1,
+    "courier_type": "foot",
+    "regions": [1, 12, 22],
+    "working_hours": ["11:35-14:05", "09:00-11:00"]
+}
+
+ORDER = {
+    "order_id": 1,
+    "weight": 0.23,
+    "region": 12,
+    "delivery_hours": ["09:00-12:00", "16:00-21:30"]
+}
+
+# Сквозная нумерация id, чтобы сценарии не пересекались в одной базе
+# с данными make_dataset
+ids = count(1000000)
+
+
+def make_app(**config):
+    # Отдельная временная база, чтобы не трогать рабочую
+    from app import create_app
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    return create_app(dict({'DATABASE': db_file, 'TESTING': True}, **config))
+
+
+def make_hours(rnd, number):
+    hours = list()
+    for start in sorted(rnd.sample(range(0, 22 * 60, 30), number)):
+        end = min(start + rnd.choice((30, 60, 120, 240)), 24 * 60 - 1)
+        hours.append(f'{start // 60:02}:{start % 60:02}-'
+                     f'{end // 60:02}:{end % 60:02}')
+    return hours
+
+
+def make_dataset(size, seed=0):
+    # Одинаковые данные при каждом запуске, id с 1 до size
+    rnd = random.Random(seed)
+    regions = max(size // ORDERS_PER_REGION, 1)
+    couriers = [{
+        'courier_id': i,
+        'courier_type': rnd.choice(TYPES),
+        'regions': rnd.sample(range(1, regions + 1), min(3, regions)),
+        'working_hours': make_hours(rnd, rnd.randint(1, 3))
+    } for i in range(1, size + 1)]
+    orders = [{
+        'order_id': i,
+        'weight': round(rnd.uniform(0.01, 10), 2),
+        'region': rnd.randint(1, regions),
+        'delivery_hours': make_hours(rnd, rnd.randint(1, 2))
+    } for i in range(1, size + 1)]
+    return couriers, orders
+
+
+def measure(func, items, repeat):
+    # Медиана времени одной операции по repeat прогонам, мкс
+    times = list()
+    for run in range(repeat):
+        start = time.perf_counter()
+        func(items[run])
+        times.append((time.perf_counter() - start) / len(items[run]) * 1e6)
+    return statistics.median(times)
+
+
+def per_call(func, number):
+    # Среднее время одного вызова, мкс
+    return timeit.timeit(func, number=number) / number * 1e6
+
+
+def split(items, repeat):
+    # Свои элементы на каждый повтор: assign и complete меняют данные
+    step = len(items) // repeat
+    return [items[i * step:(i + 1) * step] for i in range(repeat)]
+
+
+def report(results):
+    for name, value in results.items():
+        print(f'{name:<50} {value:12.2f} us/op', flush=True)
+
+
+def bench_validation(couriers, orders, repeat=3, uncached=False):
+    # Проверка схем закешированными валидаторами, с uncached ещё и
+    # jsonschema.validate, который собирает валидатор при каждом вызове
+    results = dict()
+    for name, validator, items in (
+            ('courier', POST_COURIER_VALIDATOR, couriers),
+            ('order', POST_ORDER_VALIDATOR, orders)):
+        results[f'validate {name}'] = measure(
+            lambda items: [validate(instance=i, validator=validator)
+                           for i in items], [items] * repeat, repeat)
+        if uncached:
+            schema = validator.schema
+            results[f'validate {name} (jsonschema)'] = measure(
+                lambda items: [jsonschema_validate(instance=i, schema=schema)
+                               for i in items], [items] * repeat, repeat)
+    return results
+
+
+def bench_hours(number=100000):
+    # Разбор и форматирование промежутка времени: datetime против минут
+    start, end = datetime(1900, 1, 1, 9), datetime(1900, 1, 1, 18)
+    return {
+        'parse: datetime.strptime': per_call(
+            lambda: datetime.strptime('09:00', '%H:%M'), number),
+        'parse: parse_time': per_call(lambda: parse_time('09:00'), number),
+        'format: datetime.strftime': per_call(
+            lambda: f'{start.strftime("%H:%M")}-{end.strftime("%H:%M")}',
+            number),
+        'format: format_interval': per_call(
+            lambda: format_interval(540, 1080), number)
+    }
+
+
+def bench_json(orders, number=20):
+    # Разбор тела импорта и кодирование ответа assign: json против json_io,
+    # время на один элемент
+    body = dumps({'data': orders})
+    response = {'orders': [{'id': i['order_id']} for i in orders],
+                'assigned_time': '2021-01-10T09:32:14.42Z'}
+    results = dict()
+    for name, loads_, dumps_ in (('json', loads, dumps),
+                                 (json_io.BACKEND, json_io.loads,
+                                  json_io.dumps)):
+        results[f'{name}: loads import'] = per_call(
+            lambda: loads_(body), number) / len(orders)
+        results[f'{name}: dumps assign'] = per_call(
+            lambda: dumps_(response), number) / len(orders)
+    return results
+
+
+def bench_pack(sizes=(10000, 100000, 1000000), capacity=50):
+    # Время выбора заказов под грузоподъёмность, numpy против цикла
+    results = dict()
+    for size in sizes:
+        weights = [random.uniform(0.01, 50) for _ in range(size)]
+        if assignment.numpy is not None:
+            results[f'pack_orders numpy x{size}'] = per_call(
+                lambda: assignment.pack_orders(weights, capacity), 1)
+        numpy, assignment.numpy = assignment.numpy, None
+        try:
+            results[f'pack_orders python x{size}'] = per_call(
+                lambda: assignment.pack_orders(weights, capacity), 1)
+        finally:
+            assignment.numpy = numpy
+    return results
+
+
+def bench_sqlite_profile(number=2000, seconds=2, readers=4):
+    # Стандартные настройки SQLite против SQLITE_PRAGMAS
+    results = dict()
+    for name, pragmas in (('default', {}), ('tuned', None)):
+        db_file = os.path.join(tempfile.mkdtemp(), 'profile.db')
+        engine = db_session.create_engine(db_file, pragmas)
+        with engine.begin() as conn:
+            conn.execute(text(
+                'CREATE TABLE items (id INTEGER PRIMARY KEY, value TEXT)'))
+        # Запись: каждая строка в своей транзакции, как отдельный запрос API
+        start = time.perf_counter()
+        for i in range(number):
+            with engine.begin() as conn:
+                conn.execute(text('INSERT INTO items VALUES (:id, :value)'),
+                             {'id': i, 'value': 'x' * 100})
+        results[f'sqlite {name}: commit'] = \
+            (time.perf_counter() - start) / number * 1e6
+
+        # Чтение параллельно с записью
+        stop = time.perf_counter() + seconds
+        reads = [0] * readers
+
+        def reader(n):
+            while time.perf_counter() < stop:
+                with engine.connect() as conn:
+                    conn.execute(text('SELECT value FROM items WHERE id = :id'),
+                                 {'id': reads[n] % number}).all()
+                reads[n] += 1
+
+        def writer():
+            i = number
+            while time.perf_counter() < stop:
+                with engine.begin() as conn:
+                    conn.execute(text('INSERT INTO items VALUES (:id, :value)'),
+                                 {'id': i, 'value': 'x' * 100})
+                i += 1
+
+        threads = [threading.Thread(target=reader, args=(n,))
+                   for n in range(readers)]
+        threads.append(threading.Thread(target=writer))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Время на одно чтение при readers потоках чтения
+        results[f'sqlite {name}: read while writing'] = \
+            seconds / max(sum(reads), 1) * 1e6
+        engine.dispose()
+    return results
+
+
+def bench_import(client, couriers, orders, chunk=IMPORT_CHUNK):
+    # Импорт курьеров и заказов запросами по chunk элементов
+    start = time.perf_counter()
+    for url, items in (('/couriers', couriers), ('/orders', orders)):
+        for i in range(0, len(items), chunk):
+            rv = client.post(url, data=json_io.dumps(
+                {'data': items[i:i + chunk]}))
+            assert rv.status_code == 201, rv.data
+    seconds = time.perf_counter() - start
+    return {'import': seconds / (len(couriers) + len(orders)) * 1e6}
+
+
+def bench_models(app, orders, number, repeat=3):
+    # Методы моделей на курьерах и заказах с id от 1 до number
+    results = dict()
+    with app.app_context():
+        db_sess = db_session.create_session()
+        courier_objects = db_sess.query(Courier).filter(
+            Courier.courier_id <= number).all()
+        order_objects = db_sess.query(Order).filter(
+            Order.order_id <= number).all()
+        # Связанные строки загружаются заранее, замеряется сама проверка
+        for courier in courier_objects:
+            courier.working_hours
+            courier.region_rows
+        for order in order_objects:
+            order.delivery_hours
+        pairs = [(courier, WorkingIntervals(courier.working_hours), order)
+                 for courier, order in zip(courier_objects, order_objects)]
+        results['Courier.check_order_time'] = measure(
+            lambda items: [c.check_order_time(o, intervals)
+                           for c, intervals, o in items],
+            [pairs] * repeat, repeat)
+        results['Courier.to_dict'] = measure(
+            lambda items: [i.to_dict() for i in items],
+            [courier_objects] * repeat, repeat)
+
+        def add_delivery_time(items):
+            for values in items:
+                Order(order_id=0).add_delivery_time_to_order(
+                    values['delivery_hours'], db_sess)
+            db_sess.rollback()
+
+        results['Order.add_delivery_time_to_order'] = measure(
+            add_delivery_time, [orders[:number]] * repeat, repeat)
+    return results
+
+
+def bench_courier_info(client, courier_ids, repeat=3,
+                       name='GET /couriers/<id>'):
+    return {name: measure(
+        lambda items: [client.get(f'/couriers/{i}') for i in items],
+        [courier_ids] * repeat, repeat)}
+
+
+def bench_lifecycle(client, courier_ids, repeat=3):
+    # Каждый курьер вызывает assign один раз и выполняет полученные
+    # заказы, после этого ответ GET включает рейтинг
+    results = dict()
+    assigned = dict()
+
+    def assign(items):
+        for courier_id in items:
+            rv = client.post('/orders/assign',
+                             data=json_io.dumps({'courier_id': courier_id}))
+            assert rv.status_code == 200, rv.data
+            assigned[courier_id] = [i['id'] for i in rv.get_json()['orders']]
+
+    results['POST /orders/assign'] = measure(
+        assign, split(courier_ids, repeat), repeat)
+
+    complete_time = datetime.now().strftime(TIME_FORMAT)
+    completions = [{'courier_id': courier_id, 'order_id': order_id,
+                    'complete_time': complete_time}
+                   for courier_id, order_ids in assigned.items()
+                   for order_id in order_ids]
+    if len(completions) >= repeat:
+        results['POST /orders/complete'] = measure(
+            lambda items: [client.post('/orders/complete',
+                                       data=json_io.dumps(i))
+                           for i in items],
+            split(completions, repeat), repeat)
+    results.update(bench_courier_info(client, list(assigned), repeat,
+                                      'GET /couriers/<id> with rating'))
+    return results
+
+
+def bench_assign_candidates(client, size=5000):
+    # Один курьер и size подходящих ему заказов в отдельном регионе
+    region = next(ids)
+    courier_id = next(ids)
+    rv = client.post('/couriers', data=dumps({'data': [
+        dict(COURIER, courier_id=courier_id, regions=[region])]}))
+    assert rv.status_code == 201, rv.data
+    orders = [dict(ORDER, order_id=next(ids), region=region, weight=0.01)
+              for _ in range(size)]
+    rv = client.post('/orders', data=dumps({'data': orders}))
+    assert rv.status_code == 201, rv.data
+    start = time.perf_counter()
+    rv = client.post('/orders/assign',
+                     data=dumps({'courier_id': courier_id}))
+    assert rv.status_code == 200, rv.data
+    return {f'POST /orders/assign, {size} candidates':
+            (time.perf_counter() - start) * 1e6}
+
+
+def bench_sessions(app, rounds=5, number=200, threads=4):
+    # Память и занятые соединения должны оставаться на одном уровне
+    def worker():
+        with app.test_client() as client:
+            for _ in range(number):
+                client.get('/couriers/1')
+                client.get('/couriers/-1')
+                client.post('/orders/complete', data='invalid')
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(rounds):
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        current, peak = tracemalloc.get_traced_memory()
+        checked_out = db_session.get_engine(app).pool.checkedout()
+        print(f'sessions round {i}: {current / 1024:10.0f} KiB traced, '
+              f'{checked_out} connections checked out')
+    seconds = time.perf_counter() - start
+    tracemalloc.stop()
+    return {f'sessions x{threads} threads':
+            seconds / (rounds * threads * number * 3) * 1e6}
+
+
+def bench_concurrent_assign(app, couriers=16, size=2000):
+    # Курьеры одного региона одновременно разбирают общие заказы
+    region = next(ids)
+    courier_ids = [next(ids) for _ in range(couriers)]
+    client = app.test_client()
+    client.post('/couriers', data=dumps({'data': [
+        dict(COURIER, courier_id=i, regions=[region]) for i in courier_ids]}))
+    client.post('/orders', data=dumps({'data': [
+        dict(ORDER, order_id=next(ids), region=region, weight=0.01)
+        for _ in range(size)]}))
+    barrier = threading.Barrier(couriers)
+    assigned = list()
+
+    def worker(courier_id):
+        with app.test_client() as client:
+            barrier.wait()
+            rv = client.post('/orders/assign',
+                             data=dumps({'courier_id': courier_id}))
+            assigned.extend(i['id'] for i in rv.get_json()['orders'])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(couriers) as executor:
+        list(executor.map(worker, courier_ids))
+    seconds = time.perf_counter() - start
+    print(f'assigned {len(assigned)} orders, '
+          f'{len(assigned) - len(set(assigned))} assigned twice')
+    return {f'concurrent assign x{couriers}, {size} orders':
+            seconds / couriers * 1e6}
+
+
+def main(size=10000, sample=1000):
+    couriers, orders = make_dataset(size)
+    report(bench_validation(couriers[:sample], orders[:sample],
+                            uncached=True))
+    report(bench_hours())
+    report(bench_json(orders))
+    report(bench_pack())
+    report(bench_sqlite_profile())
+    app = make_app()
+    client = app.test_client()
+    report(bench_import(client, couriers, orders))
+    report(bench_assign_candidates(client))
+    report(bench_concurrent_assign(app))
+    report(bench_sessions(app))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Набор замеров горячих участков моделей и ресурсов на синтетических данных.
+
+Запуск из директории app/:
+
+    python bench_suite.py --output results.json
+    python bench_suite.py --baseline results.json --threshold 0.25
+
+Для каждого размера данных (по умолчанию 1k, 10k и 100k курьеров и заказов)
+сценарии из bench.py прогоняются на новой временной базе. Результат - время
+на одну операцию в микросекундах (медиана по повторам), записывается в JSON.
+С --baseline каждый замер сравнивается с прошлым результатом, и при
+замедлении больше threshold скрипт завершается с кодом 1.
+"""
+import argparse
+import json
+import platform
+import sys
+from datetime import datetime
+
+import bench
+from api import json_io
+from data import db_session
+
+SIZES = (1000, 10000, 100000)
+
+
+def run_size(size, repeat, sample):
+    couriers, orders = bench.make_dataset(size)
+    # Кэш курьеров выключен, чтобы замерять сборку ответа
+    app = bench.make_app(COURIER_CACHE_SIZE=0)
+    client = app.test_client()
+    number = min(sample, size)
+    courier_ids = list(range(1, number + 1))
+
+    results = bench.bench_import(client, couriers, orders)
+    results.update(bench.bench_validation(
+        couriers[:number], orders[:number], repeat))
+    results.update(bench.bench_models(app, orders, number, repeat))
+    results.update(bench.bench_courier_info(client, courier_ids, repeat))
+    results.update(bench.bench_lifecycle(client, courier_ids, repeat))
+    db_session.get_engine(app).dispose()
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Возвращает список замедлившихся замеров
+    regressions = list()
+    for name, value in results.items():
+        old = baseline.get(name)
+        if old and value > old * (1 + threshold):
+            regressions.append((name, old, value))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--sample', type=int, default=1000,
+                        help='операций в одном повторе')
+    parser.add_argument('--output', help='файл для результатов в JSON')
+    parser.add_argument('--baseline', help='прошлые результаты в JSON')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='допустимое замедление, доля от baseline')
+    args = parser.parse_args(argv)
+
+    results = dict()
+    for size in args.sizes:
+        for name, value in run_size(size, args.repeat,
+                                    args.sample).items():
+            key = f'{name} x{size}'
+            results[key] = round(value, 3)
+            bench.report({key: value})
+    data = {
+        'python': platform.python_version(),
+        'json_backend': json_io.BACKEND,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new in regressions:
+            print(f'REGRESSION {name}: {old:.2f} -> {new:.2f} us/op '
+                  f'(+{(new / old - 1) * 100:.0f}%)')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
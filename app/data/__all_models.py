@@ -1,3 +1,3 @@
 from . import couriers
 from . import orders
-
+from . import stats
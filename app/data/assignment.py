@@ -0,0 +1,44 @@
+# Выбор заказов для курьера с учётом грузоподъёмности.
+# Оплата за заказ у курьера одна и та же, поэтому больше всего он
+# заработает, взяв наибольшее число заказов: для этого достаточно
+# брать самые лёгкие заказы, пока они помещаются
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Допуск на погрешность суммирования весов во float
+EPSILON = 1e-9
+# На небольшом числе заказов numpy не быстрее обычного цикла
+NUMPY_THRESHOLD = 256
+
+
+def pack_orders(weights, capacity):
+    # Возвращает индексы выбранных заказов в порядке возрастания
+    if numpy is not None and len(weights) >= NUMPY_THRESHOLD:
+        return _pack_numpy(weights, capacity)
+    chosen = list()
+    total = 0
+    for i in sorted(range(len(weights)), key=weights.__getitem__):
+        total += weights[i]
+        if total > capacity + EPSILON:
+            break
+        chosen.append(i)
+    return sorted(chosen)
+
+
+def _pack_numpy(weights, capacity):
+    weights = numpy.asarray(weights, dtype=float)
+    order = numpy.argsort(weights, kind='stable')
+    total = numpy.cumsum(weights[order])
+    count = int(numpy.searchsorted(total, capacity + EPSILON, side='right'))
+    return numpy.sort(order[:count]).tolist()
+
+
+def select_orders(courier, orders, intervals):
+    # Отбор подходящих по времени заказов и упаковка по грузоподъёмности
+    orders = [order for order in orders
+              if courier.check_order_time(order, intervals)]
+    packed = pack_orders([order.weight for order in orders],
+                         courier.get_capacity())
+    return [orders[i] for i in packed]
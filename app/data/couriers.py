@@ -1,8 +1,12 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 from sqlalchemy.orm import validates, relationship
-from datetime import datetime
-from json import loads, dumps
-from .db_session import SqlAlchemyBase
+import logging
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from .db_session import SqlAlchemyBase, existing_ids
+from .hours import parse_time, format_interval
+
+logger = logging.getLogger(__name__)
 
 
 class Courier(SqlAlchemyBase):
@@ -10,9 +14,22 @@ class Courier(SqlAlchemyBase):
 
     courier_id = Column(Integer, primary_key=True, unique=True)
     courier_type = Column(String, nullable=False)
-    regions = Column(String, nullable=False)
+    region_rows = relationship("CourierRegion",
+                               order_by="CourierRegion.position",
+                               cascade="all, delete-orphan")
     working_hours = relationship("WorkingHours")
     earnings = Column(Integer, default=0)
+    # Растёт при каждом изменении курьера, по ней проверяются записи
+    # кэша ответов GET /couriers/<id> во всех процессах
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    orders = relationship("Order", back_populates="courier")
+    # Невыполненные заказы, одним JOIN через joinedload
+    outstanding_orders = relationship(
+        "Order",
+        primaryjoin="and_(Courier.courier_id == Order.deliver, "
+                    "Order.complete == False)",
+        order_by="Order.order_id",
+        viewonly=True)
 
     keys = ('courier_id', 'courier_type', 'regions', 'working_hours')
     coefficient = {'foot': 2, 'bike': 5, 'car': 9}
@@ -30,47 +47,91 @@ class Courier(SqlAlchemyBase):
             raise ValueError('Invalid courier type')
         return value
 
-    @validates('regions')
-    def validate_regions(self, key, value):
-        if not isinstance(value, list):
-            raise ValueError(f"Regions must be list type")
-        for region in value:
-            if (not isinstance(region, int)) or region <= 0:
-                raise ValueError(
-                    f"Invalid region {region}, region must be an integer")
-        return dumps(value)
+    @property
+    def regions(self):
+        return [i.region for i in self.region_rows]
+
+    @regions.setter
+    def regions(self, value):
+        self.region_rows = [CourierRegion(**row) for row in
+                            self.parse_regions(self.courier_id, value)]
+
+    def touch(self):
+        # Увеличение в самом UPDATE, параллельные изменения не теряются
+        self.version = Courier.version + 1
 
     def get_capacity(self):
         return self.capacity[self.courier_type]
 
+    def get_order_cost(self):
+        return 500 * self.coefficient[self.courier_type]
+
     def to_dict(self):
         data = {
             'courier_id': self.courier_id,
             'courier_type': self.courier_type,
-            'regions': loads(self.regions),
+            'regions': self.regions,
         }
         working_hours = list()
         for i in self.working_hours:
-            work_hour = f'{i.start.strftime("%H:%M")}-{i.end.strftime("%H:%M")}'
-            working_hours.append(work_hour)
+            working_hours.append(format_interval(i.start, i.end))
         data['working_hours'] = working_hours
         return data
 
-    def add_working_time_to_courier(self, values, db_sess):
+    @classmethod
+    def to_row(cls, data):
+        # Строка для bulk insert, поля проверяются теми же валидаторами
+        return {
+            'courier_id': cls.validate_id(None, 'courier_id',
+                                          data['courier_id']),
+            'courier_type': cls.validate_type(None, 'courier_type',
+                                              data['courier_type'])
+        }
+
+    @classmethod
+    def existing_ids(cls, db_sess, ids):
+        return existing_ids(db_sess, cls.courier_id, ids)
+
+    @staticmethod
+    def parse_regions(courier_id, values):
+        if not isinstance(values, list):
+            raise ValueError(f"Regions must be list type")
+        rows = list()
+        for position, region in enumerate(values):
+            if (not isinstance(region, int)) or region <= 0:
+                raise ValueError(
+                    f"Invalid region {region}, region must be an integer")
+            rows.append({
+                'courier_id': courier_id,
+                'position': position,
+                'region': region
+            })
+        return rows
+
+    @staticmethod
+    def parse_working_hours(courier_id, values):
+        rows = list()
         for time in values:
             start, end = time.split('-')
             work_hours = {
-                'courier_id': self.courier_id,
-                'start': datetime.strptime(start, '%H:%M'),
-                'end': datetime.strptime(end, '%H:%M')
+                'courier_id': courier_id,
+                'start': parse_time(start),
+                'end': parse_time(end)
             }
             if work_hours['start'] > work_hours['end']:
                 raise ValueError('End of work before start')
+            rows.append(work_hours)
+        return rows
+
+    def add_working_time_to_courier(self, values, db_sess):
+        for work_hours in self.parse_working_hours(self.courier_id, values):
             courier_hours = WorkingHours(**work_hours)
             db_sess.add(courier_hours)
+            self.working_hours.append(courier_hours)
 
     def update(self, db_sess, **kwargs):
-        print(kwargs)
+        logger.debug('courier update id=%d fields=%s', self.courier_id,
+                     kwargs)
         for key, value in kwargs.items():
             if key == 'courier_type':
                 self.courier_type = value
@@ -86,22 +147,56 @@ class Courier(SqlAlchemyBase):
             else:
                 raise ValueError('Unknown key in data')
 
-    def check_order_time(self, order):
-        # Перебираем времена работы курьера
+    def check_order_time(self, order, intervals=None):
+        # intervals можно построить один раз на весь assign
+        if intervals is None:
+            intervals = WorkingIntervals(self.working_hours)
+        # Перебираем времена доставки заказа
         for deliv_time in order.delivery_hours:
-            for work_time in self.working_hours:
-                # Проверка вхождения начала времени получения в промежуток
-                # времени доставки, если входит, то
-                # прерываем цикл и принимаем заказ
-                if deliv_time.start <= work_time.start < deliv_time.end or \
-                        work_time.start <= deliv_time.start < work_time.end:
-                    return True  # Если входит - возвращаем True
+            if intervals.overlaps(deliv_time.start, deliv_time.end):
+                return True  # Если входит - возвращаем True
         return False  # Если True не вернули - возвращаем False
 
 
+class WorkingIntervals:
+    # Отсортированные промежутки работы курьера,
+    # пересечение с промежутком доставки ищется бинарным поиском
+    def __init__(self, working_hours):
+        hours = sorted((i.start, i.end) for i in working_hours)
+        self.starts = [start for start, end in hours]
+        # Максимальный конец работы среди первых i промежутков
+        self.max_ends = list(accumulate((end for start, end in hours), max))
+
+    def overlaps(self, start, end):
+        # Начало работы попадает в промежуток доставки
+        i = bisect_left(self.starts, start)
+        if i < len(self.starts) and self.starts[i] < end:
+            return True
+        # Начало доставки попадает в один из промежутков работы
+        i = bisect_right(self.starts, start)
+        return i > 0 and self.max_ends[i - 1] > start
+
+
 class WorkingHours(SqlAlchemyBase):
     __tablename__ = 'working_hours'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    courier_id = Column(Integer, ForeignKey('couriers.courier_id'))
-    start = Column(DateTime, nullable=False)
-    end = Column(DateTime, nullable=False)
+    courier_id = Column(Integer, ForeignKey('couriers.courier_id'),
+                        index=True)
+    # Минуты с начала суток
+    start = Column(Integer, nullable=False)
+    end = Column(Integer, nullable=False)
+
+
+class CourierRegion(SqlAlchemyBase):
+    __tablename__ = 'courier_regions'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    courier_id = Column(Integer, ForeignKey('couriers.courier_id'),
+                        nullable=False)
+    position = Column(Integer, nullable=False)  # Порядок регионов в ответе
+    region = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        # Курьеры региона и регионы курьера без разбора JSON
+        Index('ix_courier_regions_region_courier', 'region', 'courier_id'),
+        Index('ix_courier_regions_courier', 'courier_id', 'position'),
+    )
@@ -1,33 +1,167 @@
+import logging
+
 import sqlalchemy as sa
+from flask import current_app, has_app_context
 import sqlalchemy.orm as orm
 from sqlalchemy.orm import Session, scoped_session
 import sqlalchemy.ext.declarative as dec
 
+from . import migrations
+
+logger = logging.getLogger(__name__)
 SqlAlchemyBase = dec.declarative_base()
 __factory = None
+__engine = None
+__database = None
 
+# Ограничение на число параметров в одном IN (...) для SQLite
+IN_CHUNK_SIZE = 900
 
-def global_init(db_file):
-    global __factory
+# Настройки соединения SQLite по умолчанию: WAL не блокирует читателей
+# во время записи, synchronous=NORMAL в режиме WAL не теряет целостность
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # В килобайтах, около 64 МБ
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,  # Миллисекунды ожидания блокировки
+}
 
-    if __factory:
-        return
 
-    if not db_file or not db_file.strip():
-        raise Exception("Необходимо указать файл базы данных.")
+# Настройки пула соединений для серверных СУБД, их стоит подбирать
+# под число воркеров gunicorn. К SQLite не применяются: соединение
+# с файлом не рвётся, и pre_ping только добавил бы запрос на каждый checkout
+POOL_OPTIONS = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_recycle': 1800,  # Секунды, после которых соединение пересоздаётся
+    'pool_pre_ping': True,
+}
+
+
+def make_url(database):
+    # Путь к файлу SQLite или полный URL SQLAlchemy
+    database = database.strip()
+    if '://' in database:
+        return sa.engine.make_url(database)
+    return sa.engine.make_url(f'sqlite:///{database}')
+
 
-    conn_str = f'sqlite:///{db_file.strip()}?check_same_thread=False'
-    print(f"Подключение к базе данных по адресу {conn_str}")
+def create_engine(database, pragmas=None, **pool_options):
+    # pragmas применяются только к SQLite:
+    # None - настройки по умолчанию, {} - без настроек
+    if pragmas is None:
+        pragmas = SQLITE_PRAGMAS
+    url = make_url(database)
+    logger.info('Подключение к базе данных по адресу %s',
+                url.render_as_string(hide_password=True))
+    connect_args = dict()
+    if url.get_backend_name() == 'sqlite':
+        connect_args['check_same_thread'] = False
+    else:
+        pool_options = dict(POOL_OPTIONS, **pool_options)
+    engine = sa.create_engine(url, echo=False, connect_args=connect_args,
+                              **pool_options)
 
-    engine = sa.create_engine(conn_str, echo=False)
-    sess = orm.sessionmaker(bind=engine)
-    __factory = orm.scoped_session(sess)
+    if url.get_backend_name() == 'sqlite':
+        @sa.event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for key, value in pragmas.items():
+                cursor.execute(f'PRAGMA {key}={value}')
+            cursor.close()
+
+    return engine
+
+
+def connect(database, pragmas=None, **pool_options):
+    # Создаёт движок и фабрику сессий, таблицы и миграции.
+    # database - путь к файлу SQLite, URL SQLAlchemy или словарь
+    # вида {'url': ..., 'pool_size': ..., 'pragmas': ...}
+    if isinstance(database, dict):
+        options = dict(database)
+        database = options.pop('url', None)
+        pragmas = options.pop('pragmas', pragmas)
+        pool_options = dict(options, **pool_options)
+
+    if not database or not database.strip():
+        raise Exception("Необходимо указать файл базы данных.")
+
+    engine = create_engine(database, pragmas, **pool_options)
+    factory = orm.scoped_session(orm.sessionmaker(bind=engine))
 
     from . import __all_models
 
     SqlAlchemyBase.metadata.create_all(engine)
+    migrations.upgrade(engine, SqlAlchemyBase.metadata)
+    return engine, factory
+
+
+def global_init(database, pragmas=None, **pool_options):
+    # База по умолчанию для скриптов без приложения (backfill.py).
+    # Приложение подключает свою базу в init_app
+    global __factory, __engine, __database
+
+    if __factory:
+        if database != __database:
+            raise Exception("Подключена другая база данных.")
+        return
+
+    __engine, __factory = connect(database, pragmas, **pool_options)
+    __database = database
+
+
+def _get_state(app=None):
+    # (движок, фабрика сессий) приложения, а вне приложения -
+    # заданные через global_init
+    if app is None and has_app_context():
+        app = current_app
+    if app is not None and 'db_session' in app.extensions:
+        return app.extensions['db_session']
+    return __engine, __factory
+
+
+def create_session(app=None) -> Session:
+    # Сессия текущего потока, в обработчиках запросов одна на весь запрос
+    factory = _get_state(app)[1]
+    if factory is None:
+        raise Exception("База данных не подключена.")
+    return factory()
+
+
+def remove_session(exception=None):
+    # Закрывает сессию текущего потока и возвращает соединение в пул
+    factory = _get_state()[1]
+    if factory is not None:
+        factory.remove()
+
+
+def init_app(app):
+    # Движок и фабрика сессий принадлежат приложению, поэтому приложения
+    # с разными DATABASE в одном процессе не мешают друг другу.
+    # Сессия закрывается после каждого запроса при любом способе выхода
+    # из обработчика, закрывать её вручную в ресурсах не нужно
+    app.extensions['db_session'] = connect(app.config['DATABASE'])
+    app.teardown_appcontext(remove_session)
+
+
+def get_engine(app=None):
+    return _get_state(app)[0]
+
+
+def existing_ids(db_sess, column, ids):
+    # Возвращает множество id из ids, которые уже есть в таблице
+    ids = [i for i in ids if isinstance(i, int) and not isinstance(i, bool)]
+    found = set()
+    for i in range(0, len(ids), IN_CHUNK_SIZE):
+        chunk = ids[i:i + IN_CHUNK_SIZE]
+        found.update(
+            row[0] for row in db_sess.query(column).filter(column.in_(chunk)))
+    return found
 
 
-def create_session() -> Session:
-    global __factory
-    return __factory()
\ No newline at end of file
+def bulk_insert(db_sess, model, rows):
+    # Вставка списка словарей одним executemany, без ORM-объектов
+    if rows:
+        db_sess.execute(sa.insert(model), rows)
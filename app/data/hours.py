@@ -0,0 +1,25 @@
+# Промежутки времени хранятся как минуты с начала суток
+from datetime import datetime
+
+TIME_FORMAT = '%H:%M'
+DIGITS = frozenset('0123456789')
+
+
+def parse_time(value):
+    # Быстрый разбор строгого формата HH:MM без strptime
+    if len(value) == 5 and value[2] == ':' and \
+            DIGITS.issuperset(value[:2] + value[3:]):
+        hours, minutes = int(value[:2]), int(value[3:])
+        if hours < 24 and minutes < 60:
+            return hours * 60 + minutes
+    # Всё остальное отдаём strptime, чтобы сохранить его сообщения об ошибках
+    time = datetime.strptime(value, TIME_FORMAT)
+    return time.hour * 60 + time.minute
+
+
+def format_time(value):
+    return f'{value // 60:02d}:{value % 60:02d}'
+
+
+def format_interval(start, end):
+    return f'{format_time(start)}-{format_time(end)}'
@@ -0,0 +1,140 @@
+# Шаги обновления схемы уже существующих баз данных.
+# Каждый шаг должен быть идемпотентным: он выполняется при каждом запуске
+from json import loads
+
+from sqlalchemy import Integer, inspect, orm, select, text
+from sqlalchemy.schema import CreateTable
+
+HOURS_TABLES = ('working_hours', 'delivery_hours')
+# Индексы, которые заменены другими и удаляются из старых баз
+REPLACED_INDEXES = ('ix_orders_deliver_complete',)
+
+
+def create_missing_indexes(engine, metadata):
+    # create_all не добавляет индексы к уже существующим таблицам
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def drop_replaced_indexes(engine, metadata):
+    with engine.begin() as conn:
+        for name in REPLACED_INDEXES:
+            conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+
+
+def hours_to_minutes(engine, metadata):
+    # Раньше start/end хранились как DateTime вида
+    # '1900-01-01 HH:MM:SS.ffffff', переводим их в минуты с начала суток.
+    # Такие базы могли быть только на SQLite
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.begin() as conn:
+        for table in HOURS_TABLES:
+            for column in ('start', 'end'):
+                conn.execute(text(
+                    f'UPDATE {table} SET "{column}" = '
+                    f'CAST(substr("{column}", 12, 2) AS INTEGER) * 60 + '
+                    f'CAST(substr("{column}", 15, 2) AS INTEGER) '
+                    f'WHERE typeof("{column}") = \'text\''))
+
+
+def regions_to_table(engine, metadata):
+    # Раньше регионы курьера хранились JSON-строкой в couriers.regions,
+    # переносим их в courier_regions и удаляем старую колонку
+    columns = inspect(engine).get_columns('couriers')
+    if 'regions' not in {column['name'] for column in columns}:
+        return
+    with engine.begin() as conn:
+        rows = list()
+        for courier_id, regions in conn.execute(
+                text('SELECT courier_id, regions FROM couriers')):
+            for position, region in enumerate(loads(regions)):
+                rows.append({
+                    'courier_id': courier_id,
+                    'position': position,
+                    'region': region
+                })
+        if rows:
+            conn.execute(metadata.tables['courier_regions'].insert(), rows)
+        conn.execute(text('ALTER TABLE couriers DROP COLUMN regions'))
+
+
+def add_courier_version(engine, metadata):
+    # Версия курьера для проверки кэша ответов GET /couriers/<id>
+    columns = inspect(engine).get_columns('couriers')
+    if 'version' in {column['name'] for column in columns}:
+        return
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE couriers ADD COLUMN version '
+                          'INTEGER NOT NULL DEFAULT 0'))
+
+
+def deliver_to_integer(engine, metadata):
+    # Раньше orders.deliver хранил id курьера строкой, переводим колонку
+    # в INTEGER с внешним ключом на couriers
+    columns = {column['name']: column
+               for column in inspect(engine).get_columns('orders')}
+    if isinstance(columns['deliver']['type'], Integer):
+        return
+    table = metadata.tables['orders']
+    with engine.begin() as conn:
+        if engine.dialect.name != 'sqlite':
+            conn.execute(text(
+                'ALTER TABLE orders ALTER COLUMN deliver TYPE INTEGER '
+                'USING deliver::integer'))
+            conn.execute(text(
+                'ALTER TABLE orders ADD FOREIGN KEY (deliver) '
+                'REFERENCES couriers (courier_id)'))
+            return
+        # SQLite не умеет менять тип колонки: собираем таблицу заново
+        # под временным именем и переносим данные
+        new_table = table.to_metadata(metadata, name='orders_new')
+        try:
+            conn.execute(CreateTable(new_table))
+        finally:
+            metadata.remove(new_table)
+        names = [column.name for column in table.columns
+                 if column.name in columns]
+        values = ['CAST(deliver AS INTEGER)' if name == 'deliver'
+                  else f'"{name}"' for name in names]
+        names = ', '.join(f'"{name}"' for name in names)
+        conn.execute(text(
+            f'INSERT INTO orders_new ({names}) '
+            f'SELECT {", ".join(values)} FROM orders'))
+        conn.execute(text('DROP TABLE orders'))
+        conn.execute(text('ALTER TABLE orders_new RENAME TO orders'))
+        for index in table.indexes:
+            index.create(conn)
+
+
+def fill_region_stats(engine, metadata):
+    # Таблица courier_region_stats появилась позже заказов: в обновлённой
+    # базе она пустая, и рейтинг курьеров пропал бы до ручного пересчёта
+    stats = metadata.tables['courier_region_stats']
+    orders = metadata.tables['orders']
+    with engine.connect() as conn:
+        if conn.execute(select(stats).limit(1)).first() is not None:
+            return
+        if conn.execute(select(orders.c.order_id).where(
+                orders.c.complete == True).limit(1)).first() is None:
+            return
+    from .stats import backfill_region_stats
+    with orm.Session(bind=engine) as db_sess:
+        backfill_region_stats(db_sess)
+
+
+STEPS = [
+    create_missing_indexes,
+    drop_replaced_indexes,
+    hours_to_minutes,
+    regions_to_table,
+    deliver_to_integer,
+    add_courier_version,
+    fill_region_stats,
+]
+
+
+def upgrade(engine, metadata):
+    for step in STEPS:
+        step(engine, metadata)
@@ -0,0 +1,138 @@
+# Индекс свободных заказов в памяти процесса: район -> заказы,
+# отсортированные по весу, с промежутками доставки в минутах.
+# Источник истины - БД: индекс загружается из неё при старте, а заказ
+# всё равно забирается условным UPDATE, поэтому устаревшая запись
+# в индексе приводит только к пропуску заказа
+import logging
+import threading
+from bisect import bisect_left, insort
+from heapq import merge
+
+from flask import current_app
+from sqlalchemy.orm import selectinload
+
+from . import db_session
+from .assignment import EPSILON
+from .db_session import IN_CHUNK_SIZE
+from .orders import Order
+
+logger = logging.getLogger(__name__)
+
+
+class OrderIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # region -> [(weight, order_id, ((start, end), ...))]
+        self.regions = dict()
+        # order_id -> (region, weight)
+        self.orders = dict()
+
+    def __len__(self):
+        return len(self.orders)
+
+    def load(self, db_sess):
+        orders = db_sess.query(Order).options(
+            selectinload(Order.delivery_hours)
+        ).filter(Order.deliver == None)
+        with self.lock:
+            self.regions.clear()
+            self.orders.clear()
+            for order in orders:
+                self._add(order.order_id, order.region, order.weight,
+                          [(i.start, i.end) for i in order.delivery_hours])
+            for entries in self.regions.values():
+                entries.sort()
+        logger.info('order index loaded orders=%d', len(self.orders))
+
+    def add_rows(self, orders, delivery_hours):
+        # Строки в формате Order.to_row и Order.parse_delivery_hours
+        hours = dict()
+        for row in delivery_hours:
+            hours.setdefault(row['order_id'], list()).append(
+                (row['start'], row['end']))
+        with self.lock:
+            for row in orders:
+                self._insert(row['order_id'], row['region'], row['weight'],
+                             hours.get(row['order_id'], ()))
+
+    def add_orders(self, orders):
+        # Заказы, снова ставшие свободными
+        with self.lock:
+            for order in orders:
+                self._insert(order.order_id, order.region, order.weight,
+                             [(i.start, i.end) for i in order.delivery_hours])
+
+    def discard(self, order_ids):
+        with self.lock:
+            for order_id in order_ids:
+                item = self.orders.pop(order_id, None)
+                if item is None:
+                    continue
+                region, weight = item
+                entries = self.regions[region]
+                del entries[bisect_left(entries, (weight, order_id))]
+                if not entries:
+                    del self.regions[region]
+
+    def discard_taken(self, db_sess, order_ids, claimed):
+        # Убирает из индекса заказы после claim. Незабранный заказ
+        # убирается, только если в БД он уже у другого курьера: иначе
+        # свободный заказ пропал бы из индекса до перезапуска
+        taken = set(claimed)
+        rest = [i for i in order_ids if i not in taken]
+        for i in range(0, len(rest), IN_CHUNK_SIZE):
+            taken.update(row[0] for row in db_sess.query(
+                Order.order_id
+            ).filter(
+                Order.order_id.in_(rest[i:i + IN_CHUNK_SIZE]),
+                Order.deliver != None
+            ))
+        self.discard(taken)
+
+    def select(self, regions, capacity, intervals):
+        # То же, что отбор по времени и pack_orders по заказам из БД:
+        # самые лёгкие подходящие заказы, при равном весе - с меньшим id.
+        # Заказы районов уже отсортированы, поэтому идём слиянием
+        # и останавливаемся, как только следующий заказ не помещается
+        chosen = list()
+        total = 0
+        with self.lock:
+            lists = [self.regions[region] for region in set(regions)
+                     if region in self.regions]
+            for weight, order_id, hours in merge(*lists):
+                if not any(intervals.overlaps(start, end)
+                           for start, end in hours):
+                    continue
+                total += weight
+                if total > capacity + EPSILON:
+                    break
+                chosen.append(order_id)
+        return sorted(chosen)
+
+    def _add(self, order_id, region, weight, hours):
+        self.regions.setdefault(region, list()).append(
+            (weight, order_id, tuple(sorted(hours))))
+        self.orders[order_id] = (region, weight)
+
+    def _insert(self, order_id, region, weight, hours):
+        if order_id in self.orders:
+            return
+        insort(self.regions.setdefault(region, list()),
+               (weight, order_id, tuple(sorted(hours))))
+        self.orders[order_id] = (region, weight)
+
+
+def init_app(app):
+    # Индекс включается настройкой ORDER_INDEX. Он живёт в памяти одного
+    # процесса, поэтому подходит для запуска одним воркером
+    if not app.config.get('ORDER_INDEX'):
+        return
+    index = OrderIndex()
+    with app.app_context():
+        index.load(db_session.create_session())
+    app.extensions['order_index'] = index
+
+
+def get_index():
+    # None, если индекс выключен
+    return current_app.extensions.get('order_index')
@@ -1,9 +1,9 @@
-from sqlalchemy import Column, String, Integer, Boolean, DateTime, Float, \
-    ForeignKey
-from datetime import datetime
+from sqlalchemy import Column, Integer, Boolean, DateTime, Float, \
+    ForeignKey, Index, bindparam, text, update
 from json import dumps
 from sqlalchemy.orm import validates, relationship
-from .db_session import SqlAlchemyBase
+from .db_session import SqlAlchemyBase, existing_ids, IN_CHUNK_SIZE
+from .hours import parse_time
 
 
 class Order(SqlAlchemyBase):
@@ -13,13 +13,30 @@ class Order(SqlAlchemyBase):
     weight = Column(Float, nullable=False)
     region = Column(Integer, nullable=False)
     delivery_hours = relationship("DeliveryHours")
-    deliver = Column(String, nullable=True)
+    # Курьер, которому назначен заказ
+    deliver = Column(Integer, ForeignKey('couriers.courier_id'),
+                     nullable=True)
+    courier = relationship("Courier", back_populates="orders")
     complete = Column(Boolean, nullable=True, default=False)
     cost = Column(Integer, nullable=True)
     assign_time = Column(DateTime, nullable=True)
     complete_time = Column(DateTime, nullable=True)
     keys = ("order_id", "weight", "region", "delivery_hours")
 
+    __table_args__ = (
+        # Частичный индекс по свободным заказам для /orders/assign
+        Index('ix_orders_unassigned_region_weight', 'region', 'weight',
+              sqlite_where=text('deliver IS NULL'),
+              postgresql_where=text('deliver IS NULL')),
+        # Заказы курьера: невыполненные для assign, выполненные для рейтинга.
+        # Только назначенные заказы: по полному индексу SQLite выполнял
+        # UPDATE с deliver IS NULL в claim перебором всех свободных заказов
+        # вместо поиска по order_id
+        Index('ix_orders_assigned_deliver_complete', 'deliver', 'complete',
+              sqlite_where=text('deliver IS NOT NULL'),
+              postgresql_where=text('deliver IS NOT NULL')),
+    )
+
     @validates('order_id')
     def validate_id(self, key, value):
         if not isinstance(value, int) or value < 0:
@@ -40,16 +57,95 @@ class Order(SqlAlchemyBase):
                 f"Invalid region {value}, region must be an integer")
         return value
 
-    def add_delivery_time_to_order(self, values, db_sess):
+    @classmethod
+    def to_row(cls, data):
+        # Строка для bulk insert, поля проверяются теми же валидаторами
+        return {
+            'order_id': cls.validate_id(None, 'order_id', data['order_id']),
+            'weight': cls.validate_weight(None, 'weight', data['weight']),
+            'region': cls.validate_region(None, 'region', data['region'])
+        }
+
+    @classmethod
+    def existing_ids(cls, db_sess, ids):
+        return existing_ids(db_sess, cls.order_id, ids)
+
+    @classmethod
+    def claim(cls, db_sess, order_ids, courier_id, cost, assign_time):
+        # Назначает курьеру только те заказы, которые всё ещё свободны.
+        # Условие deliver IS NULL проверяется в самом UPDATE, поэтому
+        # параллельный assign не может забрать тот же заказ
+        claimed = set()
+        for i in range(0, len(order_ids), IN_CHUNK_SIZE):
+            result = db_sess.execute(
+                update(cls).where(
+                    cls.order_id.in_(order_ids[i:i + IN_CHUNK_SIZE]),
+                    cls.deliver == None
+                ).values(
+                    deliver=courier_id,
+                    cost=cost,
+                    assign_time=assign_time
+                ).returning(cls.order_id).execution_options(
+                    synchronize_session=False)
+            )
+            claimed.update(result.scalars())
+        return claimed
+
+    @classmethod
+    def claim_many(cls, db_sess, assignments, assign_time):
+        # Пакетный вариант claim: assignments - {courier_id: (cost, [id])}.
+        # Один executemany с тем же условием deliver IS NULL
+        table = cls.__table__
+        rows = [{'b_order_id': order_id, 'b_deliver': courier_id,
+                 'b_cost': cost}
+                for courier_id, (cost, order_ids) in assignments.items()
+                for order_id in order_ids]
+        if not rows:
+            return {courier_id: [] for courier_id in assignments}
+        result = db_sess.connection().execute(
+            table.update().where(
+                table.c.order_id == bindparam('b_order_id'),
+                table.c.deliver == None
+            ).values(
+                deliver=bindparam('b_deliver'),
+                cost=bindparam('b_cost'),
+                assign_time=assign_time
+            ), rows)
+        dialect = db_sess.get_bind().dialect
+        if dialect.supports_sane_multi_rowcount and \
+                result.rowcount == len(rows):
+            # Никто не успел забрать заказы раньше
+            return {courier_id: list(order_ids)
+                    for courier_id, (cost, order_ids) in assignments.items()}
+        # Иначе проверяем, какие заказы действительно достались курьерам
+        claimed = dict()
+        all_ids = [row['b_order_id'] for row in rows]
+        for i in range(0, len(all_ids), IN_CHUNK_SIZE):
+            claimed.update(db_sess.query(cls.order_id, cls.deliver).filter(
+                cls.order_id.in_(all_ids[i:i + IN_CHUNK_SIZE]),
+                cls.assign_time == assign_time
+            ))
+        return {courier_id: [i for i in order_ids
+                             if claimed.get(i) == courier_id]
+                for courier_id, (cost, order_ids) in assignments.items()}
+
+    @staticmethod
+    def parse_delivery_hours(order_id, values):
+        rows = list()
         for time in values:
             start, end = time.split('-')
             work_hours = {
-                'order_id': self.order_id,
-                'start': datetime.strptime(start, '%H:%M'),
-                'end': datetime.strptime(end, '%H:%M')
+                'order_id': order_id,
+                'start': parse_time(start),
+                'end': parse_time(end)
             }
             if work_hours['start'] > work_hours['end']:
                 raise ValueError('Incorrect time format')
+            rows.append(work_hours)
+        return rows
+
+    def add_delivery_time_to_order(self, values, db_sess):
+        for work_hours in self.parse_delivery_hours(self.order_id, values):
             deliv_hours = DeliveryHours(**work_hours)
             db_sess.add(deliv_hours)
 
@@ -57,6 +153,7 @@ class Order(SqlAlchemyBase):
 class DeliveryHours(SqlAlchemyBase):
     __tablename__ = 'delivery_hours'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    order_id = Column(Integer, ForeignKey('orders.order_id'))
-    start = Column(DateTime, nullable=False)
-    end = Column(DateTime, nullable=False)
+    order_id = Column(Integer, ForeignKey('orders.order_id'), index=True)
+    # Минуты с начала суток
+    start = Column(Integer, nullable=False)
+    end = Column(Integer, nullable=False)
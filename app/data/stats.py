@@ -0,0 +1,73 @@
+from sqlalchemy import Column, Integer, DateTime, ForeignKey
+from .db_session import SqlAlchemyBase
+
+
+class CourierRegionStats(SqlAlchemyBase):
+    # Накопленные данные для рейтинга курьера по региону,
+    # обновляются при каждом выполненном заказе
+    __tablename__ = 'courier_region_stats'
+
+    courier_id = Column(Integer, ForeignKey('couriers.courier_id'),
+                        primary_key=True)
+    region = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    # Время назначения заказа, выполненного раньше всех остальных
+    first_assign_time = Column(DateTime, nullable=False)
+    first_complete_time = Column(DateTime, nullable=False)
+    last_complete_time = Column(DateTime, nullable=False)
+
+    @classmethod
+    def add_order(cls, db_sess, courier_id, order):
+        stats = db_sess.get(cls, (courier_id, order.region))
+        if stats is None:
+            stats = cls(courier_id=courier_id, region=order.region, count=0,
+                        first_assign_time=order.assign_time,
+                        first_complete_time=order.complete_time,
+                        last_complete_time=order.complete_time)
+            db_sess.add(stats)
+        stats.count += 1
+        # Заказы могут завершаться не по порядку complete_time
+        if order.complete_time < stats.first_complete_time:
+            stats.first_complete_time = order.complete_time
+            stats.first_assign_time = order.assign_time
+        if order.complete_time > stats.last_complete_time:
+            stats.last_complete_time = order.complete_time
+        return stats
+
+    def average_time(self):
+        # Среднее между соседними временами по порядку выполнения:
+        # сумма разниц сворачивается в разницу последнего и первого
+        delta = self.last_complete_time - self.first_assign_time
+        return delta.total_seconds() / self.count
+
+    @classmethod
+    def get_rating(cls, db_sess, courier):
+        stats = db_sess.query(cls).filter(
+            cls.courier_id == courier.courier_id,
+            cls.region.in_(courier.regions)
+        ).all()
+        if not stats:
+            return None
+        t = min(i.average_time() for i in stats)
+        rating = (60 * 60 - min(t, 60 * 60)) / (60 * 60) * 5
+        return round(rating, 2)
+
+
+def backfill_region_stats(db_sess):
+    # Пересчитывает накопленные данные по всем выполненным заказам
+    from .couriers import Courier
+    from .orders import Order
+
+    db_sess.query(CourierRegionStats).delete()
+    orders = db_sess.query(Order).filter(
+        Order.complete == True
+    ).order_by(Order.complete_time).yield_per(1000)
+    count = 0
+    for order in orders:
+        CourierRegionStats.add_order(db_sess, order.deliver, order)
+        count += 1
+    # Рейтинг мог измениться у любого курьера, кэш ответов устаревает
+    db_sess.query(Courier).update({Courier.version: Courier.version + 1},
+                                  synchronize_session=False)
+    db_sess.commit()
+    return count
@@ -0,0 +1,20 @@
+# Запуск из директории app/: gunicorn wsgi:app
+# (файл gunicorn.conf.py подхватывается автоматически)
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8080')
+# Индекс заказов в памяти не делится между процессами
+workers = int(os.environ.get(
+    'WEB_CONCURRENCY', 1 if os.environ.get('ORDER_INDEX') == '1' else 4))
+# Приложение, движок БД и валидаторы создаются один раз в мастере
+preload_app = True
+
+
+def post_fork(server, worker):
+    from data import db_session
+    from log import setup_logging
+
+    # Соединения мастера нельзя использовать в дочернем процессе
+    db_session.get_engine(server.app.wsgi()).dispose(close=False)
+    # Поток записи логов не переживает fork
+    setup_logging()
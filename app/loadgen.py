@@ -0,0 +1,228 @@
+"""Нагрузочный тест запущенного сервиса по полному циклу работы курьера.
+
+Запуск из директории app/ при работающем сервисе:
+
+    python loadgen.py --url http://localhost:8080 --couriers 500 --orders 5000
+
+Сначала пачками импортируются курьеры и заказы, затем --concurrency потоков
+параллельно проводят курьеров через цикл: assign, complete полученных
+заказов, иногда GET и PATCH курьера. Для каждого эндпоинта выводятся
+число запросов, ошибки, запросы в секунду и перцентили времени ответа.
+Id курьеров, заказов и районов начинаются с --id-start, чтобы повторные
+запуски на одной базе не пересекались.
+"""
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+TYPES = ('foot', 'bike', 'car')
+PERCENTILES = (50, 90, 99)
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        # Начало первого и конец последнего запроса к эндпоинту
+        self.spans = dict()
+
+    def add(self, name, start, end, ok):
+        with self.lock:
+            self.latencies[name].append(end - start)
+            if not ok:
+                self.errors[name] += 1
+            first, last = self.spans.get(name, (start, end))
+            self.spans[name] = (min(first, start), max(last, end))
+
+    def report(self):
+        print(f'{"endpoint":<22} {"count":>7} {"errors":>6} {"rps":>8} '
+              + ' '.join(f'{f"p{p} ms":>8}' for p in PERCENTILES)
+              + f' {"max ms":>8}')
+        result = dict()
+        if not self.latencies:
+            print('no completed requests')
+        for name, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            first, last = self.spans[name]
+            # Промежуток может оказаться нулевым при грубом таймере
+            span = last - first
+            row = {
+                'count': len(values),
+                'errors': self.errors[name],
+                'rps': len(values) / span if span > 0 else 0.0,
+                'max_ms': values[-1] * 1000
+            }
+            for p in PERCENTILES:
+                index = min(len(values) - 1, len(values) * p // 100)
+                row[f'p{p}_ms'] = values[index] * 1000
+            print(f'{name:<22} {row["count"]:>7} {row["errors"]:>6} '
+                  f'{row["rps"]:>8.1f} '
+                  + ' '.join(f'{row[f"p{p}_ms"]:>8.2f}' for p in PERCENTILES)
+                  + f' {row["max_ms"]:>8.2f}')
+            result[name] = row
+        return result
+
+
+class Client:
+    # Одно keep-alive соединение на поток
+    def __init__(self, url, stats):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.stats = stats
+        self.local = threading.local()
+
+    def request(self, name, method, path, data=None):
+        body = json.dumps(data).encode() if data is not None else None
+        headers = {'Content-Type': 'application/json'} if body else {}
+        for attempt in range(2):
+            if getattr(self.local, 'conn', None) is None:
+                self.local.conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=60)
+            start = time.perf_counter()
+            try:
+                self.local.conn.request(method, path, body, headers)
+                response = self.local.conn.getresponse()
+                payload = response.read()
+            except (http.client.HTTPException, OSError):
+                # Сервер мог закрыть соединение, пробуем ещё раз с новым
+                self.local.conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+                continue
+            self.stats.add(name, start, time.perf_counter(),
+                           response.status < 400)
+            if payload and response.headers.get_content_type() == \
+                    'application/json':
+                return response.status, json.loads(payload)
+            return response.status, None
+
+
+def make_hours(rnd, count, length):
+    hours = list()
+    for start in sorted(rnd.sample(range(0, 24 * 60 - length, 30), count)):
+        end = start + length
+        hours.append(f'{start // 60:02}:{start % 60:02}-'
+                     f'{end // 60:02}:{end % 60:02}')
+    return hours
+
+
+def make_data(args, rnd):
+    regions = list(range(args.id_start, args.id_start + args.regions))
+    couriers = [{
+        'courier_id': args.id_start + i,
+        'courier_type': rnd.choice(TYPES),
+        'regions': rnd.sample(regions, min(args.courier_regions,
+                                           len(regions))),
+        'working_hours': make_hours(rnd, args.courier_hours, args.shift)
+    } for i in range(args.couriers)]
+    orders = [{
+        'order_id': args.id_start + i,
+        'weight': round(rnd.uniform(0.01, args.max_weight), 2),
+        'region': rnd.choice(regions),
+        'delivery_hours': make_hours(rnd, args.order_hours, args.window)
+    } for i in range(args.orders)]
+    return couriers, orders
+
+
+def import_items(client, path, items, batch):
+    for i in range(0, len(items), batch):
+        status, _ = client.request(f'POST {path}', 'POST', path,
+                                   {'data': items[i:i + batch]})
+        if status != 201:
+            raise SystemExit(f'{path} import failed with {status}, '
+                             f'try another --id-start')
+
+
+def courier_lifecycle(client, args, courier, seed):
+    # Курьер берёт заказы, пока они для него находятся
+    rnd = random.Random(seed)
+    courier_id = courier['courier_id']
+    for _ in range(args.rounds):
+        _, data = client.request('POST /orders/assign', 'POST',
+                                 '/orders/assign',
+                                 {'courier_id': courier_id})
+        orders = [i['id'] for i in data['orders']] if data else []
+        if not orders:
+            return
+        for order_id in orders:
+            client.request('POST /orders/complete', 'POST',
+                           '/orders/complete', {
+                               'courier_id': courier_id,
+                               'order_id': order_id,
+                               'complete_time': datetime.now().strftime(
+                                   TIME_FORMAT)})
+            if rnd.random() < args.get_ratio:
+                client.request('GET /couriers/<id>', 'GET',
+                               f'/couriers/{courier_id}')
+        if rnd.random() < args.patch_ratio:
+            client.request('PATCH /couriers/<id>', 'PATCH',
+                           f'/couriers/{courier_id}', {
+                               'working_hours': make_hours(
+                                   rnd, args.courier_hours, args.shift)})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--couriers', type=int, default=200)
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--regions', type=int, default=20)
+    parser.add_argument('--courier-regions', type=int, default=2,
+                        help='районов у одного курьера')
+    parser.add_argument('--courier-hours', type=int, default=2,
+                        help='промежутков работы у курьера')
+    parser.add_argument('--shift', type=int, default=240,
+                        help='длина промежутка работы, минут')
+    parser.add_argument('--order-hours', type=int, default=1,
+                        help='промежутков доставки у заказа')
+    parser.add_argument('--window', type=int, default=60,
+                        help='длина промежутка доставки, минут')
+    parser.add_argument('--max-weight', type=float, default=10)
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='элементов в одном запросе импорта')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=10,
+                        help='сколько раз курьер вызывает assign')
+    parser.add_argument('--get-ratio', type=float, default=0.2)
+    parser.add_argument('--patch-ratio', type=float, default=0.1)
+    parser.add_argument('--id-start', type=int,
+                        default=int(time.time()) % 100000 * 10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='файл для результатов в JSON')
+    args = parser.parse_args(argv)
+
+    rnd = random.Random(args.seed)
+    couriers, orders = make_data(args, rnd)
+    stats = Stats()
+    client = Client(args.url, stats)
+    start = time.perf_counter()
+    import_items(client, '/couriers', couriers, args.batch)
+    import_items(client, '/orders', orders, args.batch)
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(
+            lambda item: courier_lifecycle(client, args, *item),
+            ((courier, rnd.random()) for courier in couriers)))
+    elapsed = time.perf_counter() - start
+
+    print(f'{len(couriers)} couriers, {len(orders)} orders, '
+          f'{args.concurrency} threads, {elapsed:.1f} s')
+    result = stats.report()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'elapsed': elapsed,
+                       'endpoints': result}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
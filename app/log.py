@@ -0,0 +1,26 @@
+# Настройка логирования сервиса.
+# Обработчики запросов только кладут записи в очередь, а вывод в поток
+# выполняет отдельный поток QueueListener
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_FORMAT = '%(asctime)s level=%(levelname)s logger=%(name)s %(message)s'
+
+
+def setup_logging(level=None):
+    level = level or os.environ.get('LOG_LEVEL', 'INFO')
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(
+        log_queue, handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
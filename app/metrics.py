@@ -0,0 +1,208 @@
+# Метрики запросов в памяти процесса: гистограммы времени ответа по
+# маршруту и статусу и время фаз запроса (разбор JSON, проверка схемы,
+# запросы к БД, сериализация ответа). Время БД и проверки схемы
+# отдаётся в заголовке Server-Timing, все счётчики - на /metrics
+# в формате Prometheus. При нескольких воркерах у каждого свои счётчики.
+# Запросы к БД ещё и считаются: одинаковый по форме SQL, повторённый
+# за запрос много раз, пишется в лог как подозрение на N+1
+import logging
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин в секундах, как у клиентов Prometheus по умолчанию
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+           2.5, 5, 10)
+# Границы корзин для числа SQL-запросов
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+# Фазы в заголовке Server-Timing
+SERVER_TIMING = ('db', 'validation')
+# Сколько раз одна форма SQL может повториться за запрос
+N_PLUS_ONE_THRESHOLD = 5
+# Списки параметров IN (?, ?, ...) сворачиваются, чтобы пачки одного
+# запроса разного размера считались одной формой
+PARAMS_LIST = re.compile(r'\((?:\?|%\(\w+\)s)(?:, (?:\?|%\(\w+\)s))*\)')
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (route, method, status) -> Histogram
+        self.requests = dict()
+        # (route, phase) -> Histogram
+        self.phases = dict()
+        # route -> Histogram числа SQL-запросов
+        self.queries = dict()
+
+    def observe(self, route, method, status, seconds, phases, queries):
+        with self.lock:
+            key = (route, method, str(status))
+            if key not in self.requests:
+                self.requests[key] = Histogram()
+            self.requests[key].observe(seconds)
+            if route not in self.queries:
+                self.queries[route] = Histogram(QUERY_BUCKETS)
+            self.queries[route].observe(queries)
+            for phase, value in phases.items():
+                key = (route, phase)
+                if key not in self.phases:
+                    self.phases[key] = Histogram()
+                self.phases[key].observe(value)
+
+    def render(self):
+        lines = list()
+        with self.lock:
+            self._render(lines, 'http_request_duration_seconds',
+                         'Время обработки запроса',
+                         ('route', 'method', 'status'), self.requests)
+            self._render(lines, 'http_request_phase_seconds',
+                         'Время фазы обработки запроса',
+                         ('route', 'phase'), self.phases)
+            self._render(lines, 'http_request_queries',
+                         'Число SQL-запросов за запрос',
+                         ('route',), {(route,): histogram for route, histogram
+                                      in self.queries.items()})
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render(lines, name, description, label_names, histograms):
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} histogram')
+        for key, histogram in sorted(histograms.items()):
+            labels = ','.join(f'{label}="{value}"'
+                              for label, value in zip(label_names, key))
+            total = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',),
+                                    histogram.counts):
+                total += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+            lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+
+def add_time(phase, seconds):
+    # Вне запроса (тесты, скрипты) время никуда не пишется
+    if has_request_context() and 'phases' in g:
+        g.phases[phase] = g.phases.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        add_time(phase, perf_counter() - start)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info['query_start'] = perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    add_time('db', perf_counter() - conn.info.pop('query_start'))
+    for counter in counters:
+        counter.append(statement)
+    if has_request_context() and 'statements' in g:
+        g.statements[statement] += 1
+
+
+def statement_shape(statement):
+    return PARAMS_LIST.sub('(?)', ' '.join(statement.split()))
+
+
+def n_plus_one_suspects(statements, threshold=N_PLUS_ONE_THRESHOLD):
+    # Формы SQL, повторённые за запрос больше threshold раз
+    shapes = Counter()
+    for statement, count in statements.items():
+        shapes[statement_shape(statement)] += count
+    return [(shape, count) for shape, count in shapes.most_common()
+            if count > threshold]
+
+
+# Списки, в которые count_queries собирает выполненный SQL
+counters = list()
+
+
+@contextmanager
+def count_queries():
+    # Все SQL-запросы движка внутри блока, в том числе вне запроса:
+    # with count_queries() as queries: ...; assert len(queries) <= 3
+    queries = list()
+    counters.append(queries)
+    try:
+        yield queries
+    finally:
+        counters.remove(queries)
+
+
+def before_request():
+    g.phases = dict()
+    g.statements = Counter()
+    g.request_start = perf_counter()
+
+
+def after_request(response):
+    if 'request_start' not in g or request.path == '/metrics':
+        return response
+    seconds = perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else 'unknown'
+    queries = sum(g.statements.values())
+    registry.observe(route, request.method, response.status_code, seconds,
+                     g.phases, queries)
+    threshold = current_app.config.get('N_PLUS_ONE_THRESHOLD',
+                                       N_PLUS_ONE_THRESHOLD)
+    for shape, count in n_plus_one_suspects(g.statements, threshold):
+        logger.warning('n+1 suspect route=%s method=%s count=%d sql=%s',
+                       route, request.method, count, shape)
+    timings = [f'{phase};dur={g.phases[phase] * 1000:.3f}'
+               for phase in SERVER_TIMING if phase in g.phases]
+    timings.append(f'queries;desc="{queries}"')
+    timings.append(f'total;dur={seconds * 1000:.3f}')
+    response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+
+def metrics():
+    return Response(registry.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app, engine):
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    if not event.contains(engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+registry = Registry()
@@ -2,16 +2,41 @@ from data import db_session
 from datetime import datetime, timedelta
 import pytest
 import os
+import threading
+from contextlib import contextmanager
+from io import BytesIO
 from json import dumps
-from app import app
+from sqlalchemy import event, text
+from app import create_app
+from data.orders import Order
+from metrics import count_queries
 
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+# Путь к файлу SQLite или URL другой базы, например PostgreSQL
+TEST_DATABASE = os.environ.get('TEST_DATABASE_URL', 'db/test.db')
 # creating db
-try:
-    os.remove('db/test.db')
-except:
-    pass
-db_session.global_init('db/test.db')
+if '://' in TEST_DATABASE:
+    # Серверную базу очищаем, удаляя все таблицы
+    engine = db_session.create_engine(TEST_DATABASE)
+    from data import __all_models
+    db_session.SqlAlchemyBase.metadata.drop_all(engine)
+    engine.dispose()
+else:
+    for path in (TEST_DATABASE, f'{TEST_DATABASE}-wal',
+                 f'{TEST_DATABASE}-shm'):
+        try:
+            os.remove(path)
+        except:
+            pass
+app = create_app({'DATABASE': TEST_DATABASE})
+
+
+@contextmanager
+def max_queries(limit):
+    # Проверка верхней границы числа SQL-запросов в блоке
+    with count_queries() as queries:
+        yield queries
+    assert len(queries) <= limit, '\n'.join(queries)
 
 
 @pytest.fixture
@@ -37,7 +62,7 @@ def test_post_courier(client):
     print(rv)
     print(rv.status_code)
     assert rv.status_code == 201
-    assert rv.data == b'{"couriers": [{"id": 0}]}'
+    assert rv.get_json() == {"couriers": [{"id": 0}]}
 
 
 def test_post_courier_id_already_in_db(client):
@@ -451,6 +476,33 @@ def test_post_orders_bad_time(client):
     }
 
 
+def test_post_orders_duplicate_id_in_payload(client):
+    js = dumps({"data": [
+        {
+            "order_id": 50,
+            "weight": 1,
+            "region": 12,
+            "delivery_hours": ["09:00-18:00"]
+        },
+        {
+            "order_id": 50,
+            "weight": 2,
+            "region": 12,
+            "delivery_hours": ["09:00-18:00"]
+        }]})
+    rv = client.post('/orders', data=js)
+    print(rv.get_json())
+    assert rv.status_code == 400
+    assert rv.get_json() == {'validation_error':
+        {'orders': [{
+            'id': 50,
+            'error_description':
+                'id50 is already in the database'}
+        ]
+        }
+    }
+
+
 # Tests post /orders/assign
 def test_orders_assign(client):
     js = dumps({'courier_id': 0})
@@ -540,6 +592,19 @@ def test_orders_complete_invalid_time(client):
     assert rv.status_code == 400
 
 
+def test_orders_complete_twice(client):
+    time = datetime.now() + timedelta(minutes=40)
+    js = dumps({
+        "courier_id": 0,
+        "order_id": 0,
+        "complete_time": time.strftime(TIME_FORMAT)
+    })
+    rv = client.post('/orders/complete', data=js)
+    print(rv.get_json())
+    assert rv.status_code == 200
+    assert rv.get_json() == {'order_id': 0}
+
+
 # couriers/<int>
 def test_courier_info(client):
     rv = client.get('/couriers/0')
@@ -564,6 +629,55 @@ def test_courier_info_invalid_id(client):
     assert rv.status_code == 404
 
 
+# Приложение с другой базой в том же процессе работает со своей базой
+def test_app_owns_database(tmp_path):
+    other = create_app({'DATABASE': str(tmp_path / 'other.db')})
+    assert db_session.get_engine(other) is not db_session.get_engine(app)
+    assert other.test_client().get('/couriers/0').status_code == 404
+    assert app.test_client().get('/couriers/0').status_code == 200
+    db_session.get_engine(other).dispose()
+
+
+
+
+def test_pool_options_only_for_server_databases(tmp_path):
+    sqlite = db_session.create_engine(str(tmp_path / 'pool.db'))
+    server = db_session.create_engine('postgresql+psycopg2://u:p@host/db')
+    assert not sqlite.pool._pre_ping
+    assert server.pool._pre_ping
+    assert server.pool.size() == db_session.POOL_OPTIONS['pool_size']
+    sqlite.dispose()
+    server.dispose()
+
+def test_region_stats_filled_on_upgrade(tmp_path):
+    # База, где заказы выполнены до появления courier_region_stats
+    path = str(tmp_path / 'old.db')
+    old = create_app({'DATABASE': path})
+    client = old.test_client()
+    client.post('/couriers', data=dumps({"data": [{
+        "courier_id": 1, "courier_type": "foot", "regions": [1],
+        "working_hours": ["00:00-23:59"]}]}))
+    client.post('/orders', data=dumps({"data": [{
+        "order_id": 1, "weight": 1, "region": 1,
+        "delivery_hours": ["00:00-23:59"]}]}))
+    assign_time = client.post('/orders/assign', data=dumps(
+        {"courier_id": 1})).get_json()['assigned_time']
+    complete_time = datetime.strptime(assign_time, TIME_FORMAT) + \
+        timedelta(minutes=10)
+    client.post('/orders/complete', data=dumps({
+        "courier_id": 1, "order_id": 1,
+        "complete_time": complete_time.strftime(TIME_FORMAT)}))
+    rating = client.get('/couriers/1').get_json()['rating']
+    engine = db_session.get_engine(old)
+    with engine.begin() as conn:
+        conn.execute(text('DELETE FROM courier_region_stats'))
+    engine.dispose()
+
+    upgraded = create_app({'DATABASE': path})
+    info = upgraded.test_client().get('/couriers/1').get_json()
+    assert info['rating'] == rating
+    db_session.get_engine(upgraded).dispose()
+
 # Полный тест основных функций
 
 # Добавляем курьеров
@@ -815,3 +929,588 @@ def test_full_get_courier4_info(client):
         'working_hours': ['14:00-16:35', '16:50-18:00'],
         'earnings': 0
     }
+
+
+# Заказ остаётся у курьера, если новые часы работы всё ещё подходят
+def test_patch_working_hours_keeps_matching_order(client):
+    rv = client.post('/couriers', data=dumps({"data": [{
+        "courier_id": 20,
+        "courier_type": "foot",
+        "regions": [20],
+        "working_hours": ["09:00-12:00"]
+    }]}))
+    assert rv.status_code == 201
+    rv = client.post('/orders', data=dumps({"data": [{
+        "order_id": 20,
+        "weight": 1,
+        "region": 20,
+        "delivery_hours": ["10:00-11:00"]
+    }]}))
+    assert rv.status_code == 201
+    rv = client.post('/orders/assign', data=dumps({"courier_id": 20}))
+    assert rv.get_json()['orders'] == [{'id': 20}]
+    assigned_time = rv.get_json()['assigned_time']
+
+    rv = client.patch('/couriers/20',
+                      data=dumps({"working_hours": ["10:30-13:00"]}))
+    assert rv.status_code == 201
+    rv = client.post('/orders/assign', data=dumps({"courier_id": 20}))
+    assert rv.get_json() == {'orders': [{'id': 20}],
+                             'assigned_time': assigned_time}
+
+
+# Смена регионов снимает с курьера заказы из старых регионов
+def test_patch_regions_unassigns_orders(client):
+    rv = client.patch('/couriers/20', data=dumps({"regions": [21, 20, 22]}))
+    assert rv.status_code == 201
+    assert rv.get_json()['regions'] == [21, 20, 22]
+    rv = client.post('/orders/assign', data=dumps({"courier_id": 20}))
+    assert rv.get_json()['orders'] == [{'id': 20}]
+
+    rv = client.patch('/couriers/20', data=dumps({"regions": [21]}))
+    assert rv.status_code == 201
+    assert rv.get_json()['regions'] == [21]
+    rv = client.post('/orders/assign', data=dumps({"courier_id": 20}))
+    assert rv.get_json() == {'orders': []}
+
+
+# Соединения возвращаются в пул после запросов, в том числе с ошибками
+def test_sessions_released_after_requests():
+    def worker():
+        with app.test_client() as client:
+            for _ in range(25):
+                client.get('/couriers/0')
+                client.get('/couriers/5')
+                client.post('/orders/complete', data='invalid')
+                client.patch('/couriers/0', data=dumps({"key": "car"}))
+                client.post('/orders/assign', data=dumps({"courier_id": 0}))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert db_session.get_engine(app).pool.checkedout() == 0
+
+
+# Параллельные assign разных курьеров одного региона
+# не назначают один заказ дважды
+def test_concurrent_assign_no_double_assignment():
+    courier_ids = list(range(200, 208))
+    order_ids = list(range(1000, 1100))
+    with app.test_client() as client:
+        rv = client.post('/couriers', data=dumps({"data": [{
+            "courier_id": courier_id,
+            "courier_type": "car",
+            "regions": [77],
+            "working_hours": ["00:00-23:59"]
+        } for courier_id in courier_ids]}))
+        assert rv.status_code == 201
+        rv = client.post('/orders', data=dumps({"data": [{
+            "order_id": order_id,
+            "weight": 0.1,
+            "region": 77,
+            "delivery_hours": ["00:00-23:59"]
+        } for order_id in order_ids]}))
+        assert rv.status_code == 201
+
+    barrier = threading.Barrier(len(courier_ids))
+    assigned = dict()
+
+    def worker(courier_id):
+        with app.test_client() as client:
+            barrier.wait()
+            rv = client.post('/orders/assign',
+                             data=dumps({"courier_id": courier_id}))
+            assert rv.status_code == 200
+            assigned[courier_id] = [i['id'] for i in rv.get_json()['orders']]
+
+    threads = [threading.Thread(target=worker, args=(courier_id,))
+               for courier_id in courier_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    all_ids = [i for ids in assigned.values() for i in ids]
+    assert len(assigned) == len(courier_ids)
+    assert len(all_ids) == len(set(all_ids))
+    assert set(all_ids) <= set(order_ids)
+    # Повторный assign возвращает ровно те же заказы курьера
+    with app.test_client() as client:
+        for courier_id, ids in assigned.items():
+            rv = client.post('/orders/assign',
+                             data=dumps({"courier_id": courier_id}))
+            assert sorted(i['id'] for i in rv.get_json()['orders']) == \
+                sorted(ids)
+
+
+# UPDATE в claim ищет заказы по id, а не перебирает свободные заказы
+# по индексу deliver, заказы курьера выбираются по индексу
+def test_claim_query_plan():
+    engine = db_session.get_engine(app)
+    if engine.dialect.name != 'sqlite':
+        pytest.skip('план проверяется только на SQLite')
+    statements = list()
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        with app.app_context():
+            db_sess = db_session.create_session()
+            # На коротком списке id SQLite и так выбирает первичный ключ
+            Order.claim(db_sess, list(range(1000, 1010)), 200, 0,
+                        datetime.now())
+            db_sess.query(Order).filter(Order.deliver == 200,
+                                        Order.complete == False).all()
+            db_sess.rollback()
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+    def plan(statement, parameters):
+        with engine.connect() as conn:
+            return ' '.join(row[-1] for row in conn.exec_driver_sql(
+                f'EXPLAIN QUERY PLAN {statement}', parameters))
+
+    claim_plan = plan(*statements[0])
+    assert 'PRIMARY KEY' in claim_plan or 'autoindex' in claim_plan, \
+        claim_plan
+    assert 'deliver' not in claim_plan
+    assert 'ix_orders_assigned_deliver_complete' in plan(*statements[1])
+
+
+# Суммарный вес назначенных заказов не больше грузоподъёмности
+def test_assign_respects_capacity(client):
+    rv = client.post('/couriers', data=dumps({"data": [{
+        "courier_id": 30,
+        "courier_type": "car",
+        "regions": [30],
+        "working_hours": ["00:00-23:59"]
+    }]}))
+    assert rv.status_code == 201
+    rv = client.post('/orders', data=dumps({"data": [{
+        "order_id": order_id,
+        "weight": weight,
+        "region": 30,
+        "delivery_hours": ["10:00-12:00"]
+    } for order_id, weight in ((30, 4), (31, 5), (32, 3), (33, 6), (34, 9))]}))
+    assert rv.status_code == 201
+    rv = client.post('/orders/assign', data=dumps({"courier_id": 30}))
+    assert rv.get_json()['orders'] == [
+        {'id': 30}, {'id': 31}, {'id': 32}, {'id': 33}, {'id': 34}]
+
+    # Пешему курьеру 27 кг не унести, остаются самые лёгкие заказы
+    rv = client.patch('/couriers/30', data=dumps({"courier_type": "foot"}))
+    assert rv.status_code == 201
+    rv = client.post('/orders/assign', data=dumps({"courier_id": 30}))
+    assert rv.get_json()['orders'] == [{'id': 30}, {'id': 32}]
+
+
+def test_dispatch(client):
+    rv = client.post('/couriers', data=dumps({"data": [{
+        "courier_id": courier_id,
+        "courier_type": "foot",
+        "regions": [40],
+        "working_hours": ["00:00-23:59"]
+    } for courier_id in (40, 41)]}))
+    assert rv.status_code == 201
+    rv = client.post('/orders', data=dumps({"data": [{
+        "order_id": order_id,
+        "weight": 4,
+        "region": 40,
+        "delivery_hours": ["10:00-12:00"]
+    } for order_id in range(40, 46)]}))
+    assert rv.status_code == 201
+
+    rv = client.post('/orders/dispatch', data=dumps({"courier_ids": [41, 99]}))
+    assert rv.status_code == 400
+    assert rv.get_json()['couriers'] == [{'id': 99}]
+
+    # Каждому пешему курьеру по два заказа, заказы не пересекаются
+    rv = client.post('/orders/dispatch', data=dumps({"courier_ids": [41, 40]}))
+    assert rv.status_code == 200
+    couriers = rv.get_json()['couriers']
+    assert [i['courier_id'] for i in couriers] == [40, 41]
+    assert couriers[0]['orders'] == [{'id': 40}, {'id': 41}]
+    assert couriers[1]['orders'] == [{'id': 42}, {'id': 43}]
+
+    # Повторный вызов возвращает уже назначенные заказы
+    rv = client.post('/orders/dispatch', data=dumps({"courier_ids": [40]}))
+    assert rv.get_json()['couriers'][0] == couriers[0]
+
+
+def test_assign_from_order_index(client):
+    rv = client.post('/couriers', data=dumps({"data": [{
+        "courier_id": courier_id,
+        "courier_type": "foot",
+        "regions": [50],
+        "working_hours": ["09:00-11:00"]
+    } for courier_id in (50, 51)]}))
+    assert rv.status_code == 201
+    rv = client.post('/orders', data=dumps({"data": [{
+        "order_id": order_id,
+        "weight": weight,
+        "region": 50,
+        "delivery_hours": [hours]
+    } for order_id, weight, hours in ((50, 3, "10:00-12:00"),
+                                      (51, 2, "13:00-14:00"),
+                                      (52, 8, "10:00-12:00"))]}))
+    assert rv.status_code == 201
+
+    # Индекс загружается из БД при старте и дальше обновляется сам
+    index_app = create_app({'DATABASE': TEST_DATABASE, 'ORDER_INDEX': True})
+    index_client = index_app.test_client()
+    rv = index_client.post('/orders', data=dumps({"data": [{
+        "order_id": 53,
+        "weight": 1,
+        "region": 50,
+        "delivery_hours": ["10:00-11:00"]
+    }]}))
+    assert rv.status_code == 201
+    rv = index_client.post('/orders/assign', data=dumps({"courier_id": 50}))
+    assert rv.get_json()['orders'] == [{'id': 50}, {'id': 53}]
+
+    # Снятые при смене района заказы возвращаются в индекс
+    rv = index_client.patch('/couriers/50', data=dumps({"regions": [51]}))
+    assert rv.status_code == 201
+    rv = index_client.post('/orders/assign', data=dumps({"courier_id": 51}))
+    assert rv.get_json()['orders'] == [{'id': 50}, {'id': 53}]
+
+
+
+def test_order_index_keeps_free_orders(client):
+    rv = client.post('/couriers', data=dumps({"data": [{
+        "courier_id": courier_id,
+        "courier_type": "car",
+        "regions": [79],
+        "working_hours": ["00:00-23:59"]
+    } for courier_id in (79, 81)]}))
+    assert rv.status_code == 201
+    index_app = create_app({'DATABASE': TEST_DATABASE, 'ORDER_INDEX': True})
+    index_client = index_app.test_client()
+    index = index_app.extensions['order_index']
+
+    # Отклонённый импорт не попадает в индекс
+    size = len(index)
+    rv = index_client.post('/orders', data=dumps({"data": [{
+        "order_id": order_id,
+        "weight": 1,
+        "region": 79,
+        "delivery_hours": [hours]
+    } for order_id, hours in ((7900, "10:00-11:00"),
+                              (7901, "12:00-11:00"))]}))
+    assert rv.status_code == 400
+    assert len(index) == size
+
+    # Заказ 7900 в индексе, но в БД ещё не закоммичен: claim его
+    # пропускает, а из индекса он не убирается
+    index.add_rows([{'order_id': 7900, 'weight': 1, 'region': 79}],
+                   [{'order_id': 7900, 'start': 0, 'end': 60 * 24 - 1}])
+    rv = index_client.post('/orders/assign', data=dumps({"courier_id": 79}))
+    assert rv.get_json()['orders'] == []
+    assert 7900 in index.orders
+    rv = client.post('/orders', data=dumps({"data": [{
+        "order_id": 7900,
+        "weight": 1,
+        "region": 79,
+        "delivery_hours": ["10:00-11:00"]
+    }]}))
+    assert rv.status_code == 201
+
+    # Заказ, который забрал курьер другого воркера, из индекса убирается
+    rv = client.post('/orders/assign', data=dumps({"courier_id": 81}))
+    assert rv.get_json()['orders'] == [{'id': 7900}]
+    rv = index_client.post('/orders/assign', data=dumps({"courier_id": 79}))
+    assert rv.get_json()['orders'] == []
+    assert 7900 not in index.orders
+    db_session.get_engine(index_app).dispose()
+
+def test_courier_etag(client):
+    rv = client.post('/couriers', data=dumps({"data": [{
+        "courier_id": 60,
+        "courier_type": "bike",
+        "regions": [60],
+        "working_hours": ["09:00-18:00"]
+    }]}))
+    assert rv.status_code == 201
+    rv = client.get('/couriers/60')
+    etag = rv.headers['ETag']
+    assert rv.status_code == 200
+    assert client.get('/couriers/60').headers['ETag'] == etag
+
+    # Не изменившийся курьер отдаётся без тела
+    rv = client.get('/couriers/60', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.data == b''
+
+    # После изменения курьера ответ собирается заново
+    rv = client.patch('/couriers/60', data=dumps({"courier_type": "car"}))
+    assert rv.status_code == 201
+    rv = client.get('/couriers/60', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.get_json()['courier_type'] == 'car'
+    assert rv.headers['ETag'] != etag
+
+    # Выполнение заказа меняет заработок
+    rv = client.post('/orders', data=dumps({"data": [{
+        "order_id": 60,
+        "weight": 1,
+        "region": 60,
+        "delivery_hours": ["10:00-11:00"]
+    }]}))
+    assert rv.status_code == 201
+    etag = client.get('/couriers/60').headers['ETag']
+    client.post('/orders/assign', data=dumps({"courier_id": 60}))
+    rv = client.post('/orders/complete', data=dumps({
+        "courier_id": 60,
+        "order_id": 60,
+        "complete_time": datetime.now().strftime(TIME_FORMAT)
+    }))
+    assert rv.status_code == 200
+    rv = client.get('/couriers/60', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.get_json()['earnings'] == 4500
+
+
+# Кэш в другом процессе: изменение через другое приложение на той же
+# базе видно сразу, старый ETag не даёт 304
+def test_courier_cache_other_worker(client):
+    rv = client.post('/couriers', data=dumps({"data": [{
+        "courier_id": 61,
+        "courier_type": "bike",
+        "regions": [61],
+        "working_hours": ["09:00-18:00"]
+    }]}))
+    assert rv.status_code == 201
+    etag = client.get('/couriers/61').headers['ETag']
+    assert client.get('/couriers/61', headers={
+        'If-None-Match': etag}).status_code == 304
+
+    other = create_app({'DATABASE': TEST_DATABASE})
+    rv = other.test_client().patch('/couriers/61',
+                                   data=dumps({"courier_type": "car"}))
+    assert rv.status_code == 201
+    rv = client.get('/couriers/61', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.get_json()['courier_type'] == 'car'
+    db_session.get_engine(other).dispose()
+
+
+def test_streaming_import(client):
+    # Потоковый разбор включается для всех тел, пачки по 1000 элементов
+    threshold = app.config['IMPORT_STREAM_THRESHOLD']
+    app.config['IMPORT_STREAM_THRESHOLD'] = 0
+    try:
+        orders = [{
+            "order_id": order_id,
+            "weight": 0.5,
+            "region": 70,
+            "delivery_hours": ["10:00-11:00"]
+        } for order_id in range(100000, 101200)]
+        # Повтор id из первой пачки во второй
+        rv = client.post('/orders', data=dumps(
+            {"data": orders + [dict(orders[0], weight=1)]}))
+        assert rv.status_code == 400
+        assert rv.get_json()['validation_error']['orders'] == [{
+            'id': 100000,
+            'error_description': 'id100000 is already in the database'
+        }]
+        rv = client.post('/orders', data=dumps({"data": orders}))
+        assert rv.status_code == 201
+        assert len(rv.get_json()['orders']) == 1200
+
+        rv = client.post('/couriers', data=dumps({"data": [{
+            "courier_id": 70,
+            "courier_type": "foot",
+            "regions": [70],
+            "working_hours": ["10:00-11:00"]
+        }]}))
+        assert rv.status_code == 201
+        rv = client.post('/couriers', data='{"data": [{"courier_id": 71,')
+        assert rv.status_code == 400
+        assert client.get('/couriers/71').status_code == 404
+    finally:
+        app.config['IMPORT_STREAM_THRESHOLD'] = threshold
+
+
+
+def test_streaming_import_slow_upload(client):
+    # Пока клиент медленно отправляет тело импорта, транзакция записи
+    # не открыта, и запросы других клиентов не ждут блокировку базы
+    rv = client.post('/couriers', data=dumps({"data": [{
+        "courier_id": 74,
+        "courier_type": "foot",
+        "regions": [74],
+        "working_hours": ["10:00-11:00"]
+    }]}))
+    assert rv.status_code == 201
+    body = dumps({"data": [{
+        "order_id": order_id,
+        "weight": 0.5,
+        "region": 74,
+        "delivery_hours": ["10:00-11:00"]
+    } for order_id in range(104000, 105200)]}).encode()
+    responses = list()
+
+    def patch():
+        with app.test_client() as other:
+            responses.append(other.patch('/couriers/74', data=dumps(
+                {"courier_type": "bike"})))
+
+    class SlowStream(BytesIO):
+        # Отдаёт почти всё тело, затем "зависает" на время PATCH
+        stalled = False
+
+        def read(self, size=-1):
+            stop = len(body) - 100
+            if not self.stalled and self.tell() >= stop:
+                self.stalled = True
+                thread = threading.Thread(target=patch)
+                thread.start()
+                thread.join()
+            if not self.stalled and (size is None or size < 0 or
+                                     self.tell() + size > stop):
+                size = stop - self.tell()
+            return super().read(size)
+
+        def readinto(self, buffer):
+            # werkzeug читает тело через readinto
+            data = self.read(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
+
+    threshold = app.config['IMPORT_STREAM_THRESHOLD']
+    app.config['IMPORT_STREAM_THRESHOLD'] = 0
+    try:
+        rv = client.post('/orders', input_stream=SlowStream(body),
+                         content_type='application/json')
+        assert rv.status_code == 201
+        assert len(rv.get_json()['orders']) == 1200
+    finally:
+        app.config['IMPORT_STREAM_THRESHOLD'] = threshold
+    assert responses[0].status_code == 201
+
+# Пачка с ошибками ничего не пишет в базу: на PostgreSQL регионы
+# отклонённого курьера без строки курьера нарушали внешний ключ
+def test_import_with_errors_inserts_nothing(client):
+    with count_queries() as queries:
+        rv = client.post('/couriers', data=dumps({"data": [{
+            "courier_id": 72,
+            "courier_type": "foot",
+            "regions": [72],
+            "working_hours": ["10:00-11:00"]
+        }, {
+            "courier_id": 73,
+            "courier_type": "foot",
+            "regions": [73],
+            "working_hours": ["12:00-11:00"]
+        }]}))
+        assert rv.status_code == 400
+        assert rv.get_json() == {'validation_error': {'couriers': [{
+            'id': 73,
+            'error_description': 'End of work before start'
+        }]}}
+        rv = client.post('/orders', data=dumps({"data": [{
+            "order_id": 102000,
+            "weight": 1,
+            "region": 72,
+            "delivery_hours": ["10:00-11:00"]
+        }, {
+            "order_id": 102001,
+            "weight": 1,
+            "region": 72,
+            "delivery_hours": ["12:00-11:00"]
+        }]}))
+        assert rv.status_code == 400
+    assert not [i for i in queries if i.startswith('INSERT')], queries
+    assert client.get('/couriers/72').status_code == 404
+
+    # Пачки после ошибки не пишутся, но повтор id между ними
+    # по-прежнему попадает в список ошибок
+    threshold = app.config['IMPORT_STREAM_THRESHOLD']
+    app.config['IMPORT_STREAM_THRESHOLD'] = 0
+    try:
+        orders = [{
+            "order_id": order_id,
+            "weight": 0.5,
+            "region": 72,
+            "delivery_hours": ["10:00-11:00"]
+        } for order_id in range(102000, 103001)]
+        orders[0]['delivery_hours'] = ["12:00-11:00"]
+        rv = client.post('/orders', data=dumps(
+            {"data": orders + [orders[1]]}))
+        assert rv.status_code == 400
+        assert [i['id'] for i in rv.get_json()['validation_error']['orders']] \
+            == [102000, 102001]
+    finally:
+        app.config['IMPORT_STREAM_THRESHOLD'] = threshold
+
+
+def test_metrics(client):
+    rv = client.post('/couriers', data=dumps({"data": [{
+        "courier_id": 80,
+        "courier_type": "foot",
+        "regions": [80],
+        "working_hours": ["09:00-18:00"]
+    }]}))
+    assert rv.status_code == 201
+    timing = rv.headers['Server-Timing']
+    assert 'db;dur=' in timing and 'validation;dur=' in timing
+    rv = client.get('/couriers/80')
+    assert 'db;dur=' in rv.headers['Server-Timing']
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{route="/couriers/<int:' \
+           'courier_id>",method="GET",status="200"}' in text
+    assert 'http_request_phase_seconds_count{route="/couriers",' \
+           'phase="validation"}' in text
+    assert '/metrics' not in text
+
+
+def test_query_count(client):
+    # Число запросов не зависит от числа курьеров и заказов в запросе
+    with max_queries(4):
+        rv = client.post('/couriers', data=dumps({"data": [{
+            "courier_id": courier_id,
+            "courier_type": "car",
+            "regions": [90, 91],
+            "working_hours": ["09:00-12:00", "13:00-18:00"]
+        } for courier_id in range(90, 110)]}))
+    assert rv.status_code == 201
+    with max_queries(3):
+        rv = client.post('/orders', data=dumps({"data": [{
+            "order_id": order_id,
+            "weight": 1,
+            "region": 90,
+            "delivery_hours": ["10:00-11:00", "14:00-15:00"]
+        } for order_id in range(90, 110)]}))
+    assert rv.status_code == 201
+    with max_queries(6):
+        rv = client.post('/orders/assign', data=dumps({"courier_id": 90}))
+    assert len(rv.get_json()['orders']) == 20
+    # Курьер с невыполненными заказами - один запрос с JOIN
+    with max_queries(1):
+        client.post('/orders/assign', data=dumps({"courier_id": 90}))
+    with max_queries(8):
+        rv = client.patch('/couriers/90',
+                          data=dumps({"working_hours": ["09:00-11:00"]}))
+    assert rv.status_code == 201
+    with max_queries(10):
+        rv = client.post('/orders/complete', data=dumps({
+            "courier_id": 90,
+            "order_id": 90,
+            "complete_time": datetime.now().strftime(TIME_FORMAT)
+        }))
+    assert rv.status_code == 200
+    with max_queries(5):
+        assert client.get('/couriers/90').status_code == 200
+    # Из кэша - только проверка версии курьера
+    with max_queries(1):
+        assert client.get('/couriers/90').status_code == 200
+    with max_queries(5):
+        rv = client.post('/orders/dispatch',
+                         data=dumps({"courier_ids": list(range(90, 110))}))
+    assert rv.status_code == 200
+    assert rv.headers['Server-Timing'].count('queries') == 1
@@ -1,7 +1,8 @@
-from app import app
-from data import db_session
+from app import create_app
+from log import setup_logging
 
-db_session.global_init('db/delivery.db')
+setup_logging()
+app = create_app()
 
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    app.run()